@@ -0,0 +1,218 @@
+'''
+Offline benchmark of the drawing to route pipeline. Runs every stage on the bundled drawings and on
+generated stress images, fitting to a synthetic street graph instead of LA_MAP_PATH, and prints
+per-stage timings, peak memory and sizes as JSON:
+
+    python benchmark.py --graph grid --graph-size 80 --repeat 5 --output before.json
+'''
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2 as cv
+import numpy as np
+
+CURRENT_FILEPATH = os.path.dirname(os.path.abspath(__file__))
+DRAWINGS = ["smiley.png", "car.png", "lahacks.png", "stick_and_triangle.png"]
+
+# south west corner of the synthetic graph and its node spacing, about 100 m
+ORIGIN_LAT, ORIGIN_LON = 34.05, -118.30
+SPACING_DEGREES = 0.001
+
+
+def synthetic_graph(kind: str, size: int, seed: int = 0):
+    '''
+    size x size node street graph in osmnx's format: a jittered Manhattan grid with some curved
+    blocks, or the Delaunay triangulation of random points with its longest edges dropped
+    '''
+    import networkx as nx
+    from scipy.spatial import Delaunay
+    from shapely.geometry import LineString
+
+    rng = np.random.default_rng(seed)
+    if kind == "grid":
+        rows, cols = np.divmod(np.arange(size * size), size)
+        xy = np.stack([cols, rows], axis=1) + rng.normal(0, 0.01, (size * size, 2))
+        right = np.flatnonzero(cols < size - 1)
+        up = np.flatnonzero(rows < size - 1)
+        pairs = np.concatenate([np.stack([right, right + 1], axis=1), np.stack([up, up + size], axis=1)])
+    elif kind == "planar":
+        xy = rng.uniform(0, size - 1, (size * size, 2))
+        triangles = Delaunay(xy).simplices
+        pairs = np.concatenate([triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]]])
+        pairs = np.unique(np.sort(pairs, axis=1), axis=0)
+        lengths = np.linalg.norm(xy[pairs[:, 0]] - xy[pairs[:, 1]], axis=1)
+        pairs = pairs[lengths < np.quantile(lengths, 0.9)]
+    else:
+        raise ValueError(f"unknown graph kind {kind}")
+
+    lon = ORIGIN_LON + xy[:, 0] * SPACING_DEGREES
+    lat = ORIGIN_LAT + xy[:, 1] * SPACING_DEGREES
+    G = nx.MultiDiGraph(crs="epsg:4326")
+    for i in range(len(xy)):
+        G.add_node(i, x=float(lon[i]), y=float(lat[i]), street_count=0)
+    for k, (u, v) in enumerate(pairs.tolist()):
+        a, b = (lon[u], lat[u]), (lon[v], lat[v])
+        length = float(np.linalg.norm(xy[u] - xy[v]) * 100)
+        data = {"length": length, "oneway": False}
+        if k % 5 == 0:
+            bend = ((a[0] + b[0]) / 2 + SPACING_DEGREES / 5, (a[1] + b[1]) / 2 + SPACING_DEGREES / 5)
+            G.add_edge(u, v, geometry=LineString([a, bend, b]), **data)
+            G.add_edge(v, u, geometry=LineString([b, bend, a]), **data)
+        else:
+            G.add_edge(u, v, **data)
+            G.add_edge(v, u, **data)
+    return G
+
+
+def stress_image(resolution: int, seed: int = 0) -> np.ndarray:
+    '''
+    Black strokes on white: closed wobbly loops, polylines and circles scaled to the resolution
+    '''
+    rng = np.random.default_rng(seed)
+    img = np.full((resolution, resolution, 3), 255, dtype=np.uint8)
+    thickness = max(1, resolution // 128)
+    for _ in range(4):
+        center = rng.uniform(0.25, 0.75, 2) * resolution
+        angles = np.linspace(0, 2 * np.pi, 200)
+        radius = resolution * rng.uniform(0.1, 0.25) * (1 + 0.2 * np.sin(rng.integers(2, 7) * angles))
+        loop = center + np.stack([np.cos(angles), np.sin(angles)], axis=1) * radius[:, None]
+        cv.polylines(img, [loop.astype(np.int32)], True, (0, 0, 0), thickness)
+    for _ in range(6):
+        line = rng.uniform(0.05, 0.95, (5, 2)) * resolution
+        cv.polylines(img, [line.astype(np.int32)], False, (0, 0, 0), thickness)
+    for _ in range(3):
+        center = (rng.uniform(0.1, 0.9, 2) * resolution).astype(int).tolist()
+        cv.circle(img, center, int(resolution * rng.uniform(0.03, 0.1)), (0, 0, 0), thickness)
+    return img
+
+
+def summarize(samples: list[float]) -> dict[str, float]:
+    return {"min": min(samples), "median": statistics.median(samples), "max": max(samples)}
+
+
+def benchmark_image(name, image_bytes, ne, sw, max_points, repeat) -> dict:
+    from metrics import traced
+    from pipeline import coordinatize
+
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        _, trace = traced(coordinatize, image_bytes, ne, sw, max_points=max_points, route=True)
+        runs.append((time.perf_counter() - start, trace))
+
+    # separate run, tracemalloc slows down everything it watches
+    tracemalloc.start()
+    coordinatize(image_bytes, ne, sw, max_points=max_points, route=True)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    shape = cv.imdecode(np.frombuffer(image_bytes, np.uint8), cv.IMREAD_UNCHANGED).shape
+    stages = runs[0][1].timings.keys()
+    return {
+        "name": name,
+        "shape": list(shape),
+        "total_seconds": summarize([total for total, _ in runs]),
+        "stage_seconds": {
+            stage: summarize([trace.timings.get(stage, 0.0) for _, trace in runs])
+            for stage in stages
+        },
+        "sizes": runs[0][1].sizes,
+        "peak_python_bytes": peak,
+    }
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=CURRENT_FILEPATH, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--graph", choices=["grid", "planar"], default="grid")
+    parser.add_argument("--graph-size", type=int, default=60, help="nodes per side of the synthetic graph")
+    parser.add_argument("--resolutions", type=int, nargs="*", default=[256, 512, 1024, 2048])
+    parser.add_argument("--max-points", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workdir", help="keeps the generated graph here instead of a temporary directory")
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="lamaps-benchmark-")
+    os.makedirs(workdir, exist_ok=True)
+    graphml_path = os.path.join(workdir, f"{args.graph}-{args.graph_size}.graphml")
+
+    start = time.perf_counter()
+    if not os.path.exists(graphml_path):
+        import osmnx as ox
+        ox.save_graphml(synthetic_graph(args.graph, args.graph_size), graphml_path)
+    generate_seconds = time.perf_counter() - start
+
+    # every run has to do the image work, and src.matrix reads the graph path on import
+    os.environ["LA_MAP_PATH"] = graphml_path
+    os.environ["IMAGE_CACHE_BYTES"] = "0"
+    os.environ["IMAGE_CACHE_DIR"] = ""
+    os.environ.pop("DEBUG_DIR", None)
+    sys.path.insert(0, CURRENT_FILEPATH)
+    from src.matrix import get_tiles
+
+    start = time.perf_counter()
+    tiles = get_tiles()
+    load_seconds = time.perf_counter() - start
+    street_graph = tiles.region(90, -90, 180, -180)
+
+    # middle half of the graph
+    extent = (args.graph_size - 1) * SPACING_DEGREES
+    ne = [ORIGIN_LAT + 0.75 * extent, ORIGIN_LON + 0.75 * extent]
+    sw = [ORIGIN_LAT + 0.25 * extent, ORIGIN_LON + 0.25 * extent]
+
+    images = []
+    for name in DRAWINGS:
+        with open(os.path.join(CURRENT_FILEPATH, name), "rb") as f:
+            images.append((name, f.read()))
+    for resolution in args.resolutions:
+        images.append((f"stress_{resolution}", cv.imencode(".png", stress_image(resolution))[1].tobytes()))
+
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "graph": {
+            "kind": args.graph,
+            "size": args.graph_size,
+            "nodes": len(street_graph),
+            "edges": street_graph.num_edges,
+            "generate_seconds": generate_seconds,
+            "load_seconds": load_seconds,
+        },
+        "max_points": args.max_points,
+        "repeat": args.repeat,
+        "images": [
+            benchmark_image(name, image_bytes, ne, sw, args.max_points, args.repeat)
+            for name, image_bytes in images
+        ],
+        # ru_maxrss is in kilobytes on linux
+        "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
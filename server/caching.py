@@ -0,0 +1,153 @@
+import hashlib
+import os
+import pickle
+from collections import OrderedDict
+
+from src.files import atomic_path
+
+
+def content_key(*parts) -> str:
+    '''
+    Hex digest identifying a request by its content. bytes parts are hashed as is, the rest by repr
+    '''
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else repr(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class LRUCache:
+    '''
+    In-memory cache evicting the least recently used entries past max_bytes of pickled size
+    '''
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[object, int]] = OrderedDict()
+
+    def get(self, key: str):
+        if key not in self._entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return self._entries[key][0]
+
+    def set(self, key: str, value, nbytes: int | None = None):
+        if nbytes is None:
+            nbytes = len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        if nbytes > self.max_bytes:
+            return
+        if key in self._entries:
+            self.size -= self._entries.pop(key)[1]
+        self._entries[key] = (value, nbytes)
+        self.size += nbytes
+        while self.size > self.max_bytes:
+            _, (_, evicted_bytes) = self._entries.popitem(last=False)
+            self.size -= evicted_bytes
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "bytes": self.size}
+
+
+class DiskCache:
+    '''
+    Pickles entries under a directory so they survive restarts and are shared between processes.
+    Reads refresh a file's mtime, and the oldest files are deleted once the directory passes max_bytes
+    '''
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+        self._size = self._scan()[1]
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], f"{key}.pkl")
+
+    def _scan(self) -> tuple[list[tuple[float, int, str]], int]:
+        files = []
+        for root, _, names in os.walk(self.path):
+            for name in names:
+                if not name.endswith(".pkl"):
+                    continue
+                file = os.path.join(root, name)
+                try:
+                    stat = os.stat(file)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, file))
+        return files, sum(size for _, size, _ in files)
+
+    def get(self, key: str):
+        file = self._file(key)
+        try:
+            with open(file, "rb") as f:
+                value = pickle.load(f)
+            os.utime(file)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value):
+        with atomic_path(self._file(key)) as tmp_file:
+            with open(tmp_file, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            self._size += os.path.getsize(tmp_file)
+
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        '''
+        Deletes the least recently used files until the directory is back under 90% of max_bytes
+        '''
+        files, self._size = self._scan()
+        for _, size, file in sorted(files):
+            if self._size <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "bytes": self._size}
+
+
+class TieredCache:
+    '''
+    Memory tier in front of an optional disk tier. Disk hits are copied into memory
+    '''
+
+    def __init__(self, memory_bytes: int, disk_path: str | None = None, disk_bytes: int = 0):
+        self.memory = LRUCache(memory_bytes)
+        self.disk = DiskCache(disk_path, disk_bytes) if disk_path else None
+
+    def get(self, key: str):
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.set(key, value)
+        return value
+
+    def set(self, key: str, value):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def stats(self) -> dict:
+        stats = {"memory": self.memory.stats()}
+        if self.disk is not None:
+            stats["disk"] = self.disk.stats()
+        return stats
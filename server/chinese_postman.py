@@ -1,17 +1,176 @@
-import networkx as nx
-from postman_problems.solver import cpp
-# use my fork: https://github.com/EricPedley/postman_problems
+import os
+import time
+from functools import cache
 
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
 
-def chinese_postman_problem(edge_list: list[tuple[int,int,float]], start: int = 0):
+from metrics import record_size
+
+# odd vertex counts up to this are matched exactly, larger ones greedily with 2-opt improvement
+EXACT_MATCHING_LIMIT = int(os.getenv("EXACT_MATCHING_LIMIT", 14))
+
+
+def odd_vertices(edge_list: list[tuple[int,int,float]], num_vertices: int) -> np.ndarray:
+    edges = np.array([(u, v) for u, v, _ in edge_list], dtype=np.int64).reshape(-1, 2)
+    degrees = np.bincount(edges.ravel(), minlength=num_vertices)
+    return np.flatnonzero(degrees % 2)
+
+
+def shortest_paths_from(
+    edge_list: list[tuple[int,int,float]],
+    num_vertices: int,
+    sources: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Dijkstra from the given sources only. Returns (distances, predecessors), each (len(sources), num_vertices)
+    '''
+    u = np.array([e[0] for e in edge_list], dtype=np.int64)
+    v = np.array([e[1] for e in edge_list], dtype=np.int64)
+    w = np.array([e[2] for e in edge_list], dtype=np.float64)
+
+    # csr_matrix sums duplicate entries, so keep only the shortest of parallel edges
+    rows, cols, weights = np.concatenate([u, v]), np.concatenate([v, u]), np.concatenate([w, w])
+    order = np.lexsort((weights, cols, rows))
+    rows, cols, weights = rows[order], cols[order], weights[order]
+    first = np.concatenate([[True], (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])])
+    # zero weights would be dropped as missing entries by scipy
+    weights = np.maximum(weights[first], 1e-9)
+    graph = csr_matrix((weights, (rows[first], cols[first])), shape=(num_vertices, num_vertices))
+
+    return dijkstra(graph, directed=False, indices=sources, return_predecessors=True)
+
+
+def exact_matching(distances: np.ndarray) -> list[tuple[int, int]]:
+    '''
+    Minimum weight perfect matching by dynamic programming over subsets, for small even counts
+    '''
+    n = len(distances)
+    dist = distances.tolist()
+
+    @cache
+    def best(mask: int) -> tuple[float, tuple[tuple[int, int], ...]]:
+        if mask == 0:
+            return 0.0, ()
+        # the lowest remaining vertex has to be paired with someone
+        i = (mask & -mask).bit_length() - 1
+        rest = mask & ~(1 << i)
+        best_cost, best_pairs = np.inf, ()
+        j_mask = rest
+        while j_mask:
+            j = (j_mask & -j_mask).bit_length() - 1
+            j_mask &= j_mask - 1
+            cost, pairs = best(rest & ~(1 << j))
+            if dist[i][j] + cost < best_cost:
+                best_cost, best_pairs = dist[i][j] + cost, ((i, j),) + pairs
+        return best_cost, best_pairs
+
+    return list(best((1 << n) - 1)[1])
+
+
+def greedy_matching(distances: np.ndarray, deadline: float | None = None) -> list[tuple[int, int]]:
     '''
-    Returns vertex indices in order of traversal for a chinese postman circuit
+    Pairs the closest free vertices first, then applies the best improving 2-opt swap
+    between two pairs until none is left or the deadline passes
     '''
-    G = nx.MultiGraph()
-    for i,e in enumerate(edge_list):
-        G.add_edge(e[0], e[1], distance=e[2], id=i)
-    circuit, graph = cpp(G, start_node=start)
-    return [e[0] for e in circuit] + [circuit[0][0]]
+    n = len(distances)
+    i, j = np.triu_indices(n, k=1)
+    matched = np.zeros(n, dtype=bool)
+    a, b = [], []
+    for k in np.argsort(distances[i, j], kind="stable").tolist():
+        if not matched[i[k]] and not matched[j[k]]:
+            matched[i[k]] = matched[j[k]] = True
+            a.append(i[k])
+            b.append(j[k])
+            if 2 * len(a) == n:
+                break
+    a, b = np.array(a), np.array(b)
+
+    while deadline is None or time.time() < deadline:
+        current = distances[a, b]
+        pair_costs = current[:, None] + current[None, :]
+        # re-pair (a1, b1), (a2, b2) as (a1, a2), (b1, b2) or as (a1, b2), (b1, a2)
+        swap_same = distances[a[:, None], a[None, :]] + distances[b[:, None], b[None, :]]
+        swap_cross = distances[a[:, None], b[None, :]] + distances[b[:, None], a[None, :]]
+        gains = np.stack([pair_costs - swap_same, pair_costs - swap_cross])
+        gains[:, np.arange(len(a)), np.arange(len(a))] = 0
+
+        kind, p, q = np.unravel_index(np.argmax(gains), gains.shape)
+        if gains[kind, p, q] <= 1e-9:
+            break
+        if kind == 0:
+            a[p], b[p], a[q], b[q] = a[p], a[q], b[p], b[q]
+        else:
+            a[p], b[p], a[q], b[q] = a[p], b[q], b[p], a[q]
+
+    return list(zip(a.tolist(), b.tolist()))
+
+
+def euler_circuit(edges: list[tuple[int, int]], num_vertices: int, start: int) -> list[int]:
+    '''
+    Hierholzer's algorithm. Returns the vertices of a circuit using every edge once, starting and ending at start
+    '''
+    adjacency = [[] for _ in range(num_vertices)]
+    for e, (u, v) in enumerate(edges):
+        adjacency[u].append((v, e))
+        adjacency[v].append((u, e))
+
+    used = bytearray(len(edges))
+    next_neighbor = [0] * num_vertices
+    stack = [start]
+    circuit = []
+    while stack:
+        u = stack[-1]
+        neighbors = adjacency[u]
+        while next_neighbor[u] < len(neighbors) and used[neighbors[next_neighbor[u]][1]]:
+            next_neighbor[u] += 1
+        if next_neighbor[u] == len(neighbors):
+            circuit.append(stack.pop())
+        else:
+            v, e = neighbors[next_neighbor[u]]
+            used[e] = 1
+            stack.append(v)
+    return circuit[::-1]
+
+
+def chinese_postman_problem(
+    edge_list: list[tuple[int,int,float]],
+    start: int = 0,
+    exact_limit: int = EXACT_MATCHING_LIMIT,
+    deadline: float | None = None,
+):
+    '''
+    Returns vertex indices in order of traversal for a chinese postman circuit.
+    Odd vertices are matched exactly up to exact_limit of them, past that or once deadline
+    (a time.time() timestamp) passes the matching is greedy with 2-opt improvement
+    '''
+    if len(edge_list) == 0:
+        return [start]
+    num_vertices = max(max(u, v) for u, v, _ in edge_list) + 1
+    edges = [(u, v) for u, v, _ in edge_list]
+    if start >= num_vertices or not any(start in edge for edge in edges):
+        start = edges[0][0]
+
+    odd = odd_vertices(edge_list, num_vertices)
+    record_size("odd_vertices", len(odd))
+    if len(odd) > 0:
+        distances, predecessors = shortest_paths_from(edge_list, num_vertices, odd)
+        odd_distances = distances[:, odd]
+        if len(odd) <= exact_limit and (deadline is None or time.time() < deadline):
+            pairs = exact_matching(odd_distances)
+        else:
+            pairs = greedy_matching(odd_distances, deadline)
+
+        # walk every matched pair's shortest path a second time
+        for i, j in pairs:
+            target = odd[j]
+            while target != odd[i] and predecessors[i, target] >= 0:
+                edges.append((int(predecessors[i, target]), int(target)))
+                target = predecessors[i, target]
+
+    return euler_circuit(edges, num_vertices, start)
+
 
 if __name__ == "__main__":
     edge_list = [(0, 1, 1), (1, 2, 1), (0,2, 1), (2, 3, 1)]
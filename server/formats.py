@@ -0,0 +1,55 @@
+import gzip
+
+import numpy as np
+
+from make_gpx import gpx_bytes
+
+# response formats besides the default json, by name to media type
+MEDIA_TYPES = {
+    "gpx": "application/gpx+xml",
+    "polyline": "text/plain",
+    "float32": "application/octet-stream",
+}
+
+
+def encode_polyline(coords, precision: int = 5) -> bytes:
+    '''
+    Google's encoded polyline format of lat, lon points: zigzagged deltas written 5 bits per
+    character. All points are encoded at once, chunks that aren't needed are masked out
+    '''
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    scaled = np.round(coords * 10 ** precision).astype(np.int64)
+    deltas = np.diff(scaled, axis=0, prepend=0).ravel()
+    values = (deltas << 1) ^ (deltas >> 63)
+
+    # 32 bit values need at most 7 chunks, least significant first
+    chunks = values[:, None] >> (5 * np.arange(7)) & 31
+    num_chunks = 1 + (values[:, None] >= 32 ** np.arange(1, 7)).sum(axis=1)
+    chunk_index = np.arange(7)[None, :]
+    chars = chunks + 63
+    chars[chunk_index < num_chunks[:, None] - 1] += 0x20
+    return chars[chunk_index < num_chunks[:, None]].astype(np.uint8).tobytes()
+
+
+def pack_float32(coords) -> bytes:
+    '''
+    Little endian float32 lat, lon pairs, 8 bytes per point
+    '''
+    return np.asarray(coords, dtype="<f4").reshape(-1, 2).tobytes()
+
+
+def encode_points(coords, output: str, compress: bool = False) -> bytes:
+    '''
+    Route in one of MEDIA_TYPES' formats, gzipped when compress is set
+    '''
+    if output == "gpx":
+        return gpx_bytes(coords, compress)
+    if output == "polyline":
+        data = encode_polyline(coords)
+    elif output == "float32":
+        data = pack_float32(coords)
+    else:
+        raise ValueError(f"unknown output format {output}")
+    if compress:
+        data = gzip.compress(data, compresslevel=6, mtime=0)
+    return data
@@ -1,19 +1,32 @@
 import cv2 as cv
 from collections import defaultdict
+import heapq
 import numpy as np
-from itertools import combinations, product, pairwise
+from itertools import combinations, pairwise
+from scipy.spatial import cKDTree
 import os
-import sys
 from chinese_postman import chinese_postman_problem
-sys.setrecursionlimit(int(1e6))
+from metrics import record_size, stage
 
 CURRENT_FILEPATH = os.path.dirname(os.path.abspath(__file__))
 
-def skeletonize(img: cv.Mat) -> cv.Mat:
+# working resolution of the image stage: the long side of the cropped drawing, in pixels per output
+# point rounded up to a power of two, so nearby max_points share the cached skeleton
+WORKING_PIXELS_PER_POINT = 32
+MIN_WORKING_SIZE = 512
+MAX_WORKING_SIZE = 4096
+# blank pixels kept around the ink so thinning doesn't run into the border
+CROP_MARGIN = 4
+# section endpoints closer than this many pixels of the uploaded image are joined
+JOIN_RADIUS = 5
+
+
+def ink_mask(img: cv.Mat) -> cv.Mat:
     """
-    Skeletonizes an rgb image
+    Thresholds a gray, rgb or rgba image into white ink on a black background
     """
-    img = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
+    if img.ndim == 3:
+        img = cv.cvtColor(img, cv.COLOR_BGR2GRAY if img.shape[2] == 3 else cv.COLOR_BGRA2GRAY)
     # convert to binary
     _, img = cv.threshold(img, 127, 255, cv.THRESH_BINARY)
 
@@ -21,132 +34,283 @@ def skeletonize(img: cv.Mat) -> cv.Mat:
     count_hi = np.sum(img>0)
     if count_hi > 0.5 * img.size:
         img = cv.bitwise_not(img)
-    
-    
-    img = cv.ximgproc.thinning(img)
     return img
 
 
+def skeletonize(mask: cv.Mat) -> cv.Mat:
+    """
+    Thins an ink mask down to one pixel wide lines
+    """
+    return cv.ximgproc.thinning(mask)
+
+
+def working_size(max_points: int) -> int:
+    size = 1 << int(np.ceil(np.log2(max(max_points, 1) * WORKING_PIXELS_PER_POINT)))
+    return int(np.clip(size, MIN_WORKING_SIZE, MAX_WORKING_SIZE))
+
+
+def ingest(
+    img: cv.Mat,
+    size: int,
+    debug: dict[str, cv.Mat] | None = None,
+) -> tuple[cv.Mat, np.ndarray, float]:
+    """
+    Ink mask of just the drawing: cropped to the ink's bounding box plus CROP_MARGIN and shrunk
+    so its long side is at most size pixels, keeping every pixel that had any ink so thin strokes
+    survive. Returns (mask, (x, y) offset of the crop, scale), to_original maps points back
+    """
+    with stage("ink_mask"):
+        mask = ink_mask(img)
+    if debug is not None:
+        debug["0_original"] = img
+
+    x, y, w, h = cv.boundingRect(mask)
+    if w == 0 or h == 0:
+        raise ValueError("image has no drawing")
+    x0, y0 = max(x - CROP_MARGIN, 0), max(y - CROP_MARGIN, 0)
+    x1, y1 = min(x + w + CROP_MARGIN, mask.shape[1]), min(y + h + CROP_MARGIN, mask.shape[0])
+    mask = mask[y0:y1, x0:x1]
+
+    scale = min(1.0, size / max(mask.shape))
+    if scale < 1:
+        with stage("downscale"):
+            shape = (max(round(mask.shape[1] * scale), 1), max(round(mask.shape[0] * scale), 1))
+            mask = cv.resize(mask, shape, interpolation=cv.INTER_AREA)
+            mask[mask > 0] = 255
+    record_size("working_pixels", mask.size)
+    return mask, np.array([x0, y0]), scale
+
+
+def working_radius(radius: float, scale: float) -> float:
+    """
+    A distance in uploaded image pixels as pixels of ingest's mask, at least one so adjacent ends still join
+    """
+    return max(radius * scale, 1.0)
+
+
+def to_original(points: list[tuple[int, int]], offset: np.ndarray, scale: float) -> list[tuple[float, float]]:
+    """
+    x, y points found in ingest's mask as points of the uploaded image
+    """
+    if scale == 1:
+        return [(x + int(offset[0]), y + int(offset[1])) for x, y in points]
+    # pixel centers line up, not their corners
+    pixels = (np.asarray(points, dtype=np.float64).reshape(-1, 2) + 0.5) / scale - 0.5 + offset
+    return [tuple(p) for p in pixels.tolist()]
+
+
+# (row, col) offsets of the 8 neighbors, bit k of a neighborhood code is set when neighbor k is on
+NEIGHBOR_OFFSETS = [(-1, 0), (1, 0), (0, -1), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1)]
+
+
+def _is_junction_code(code: int) -> bool:
+    neighbor_diffs = [NEIGHBOR_OFFSETS[k] for k in range(8) if code >> k & 1]
+
+    # for every subset of 3
+    for v1, v2, v3 in combinations(neighbor_diffs, 3):
+        # if all 3 are orthogonal or opposite, it's an intersection
+        if np.dot(v1, v2) <= 0 and np.dot(v1, v3) <= 0 and np.dot(v2, v3) <= 0:
+            return True
+    return False
+
+
+# lookup tables indexed by neighborhood code
+JUNCTION_TABLE = np.array([_is_junction_code(code) for code in range(256)])
+NEIGHBOR_COUNT_TABLE = np.array([bin(code).count("1") for code in range(256)], dtype=np.uint8)
+
+
+def neighborhood_codes(skeleton: cv.Mat) -> np.ndarray:
+    """
+    8 bit code of every pixel's on/off neighbors, for the whole image at once
+    """
+    on = (np.asarray(skeleton) > 0).astype(np.uint8)
+    padded = np.pad(on, 1)
+    rows, cols = on.shape
+    codes = np.zeros(on.shape, dtype=np.uint8)
+    for bit, (dx, dy) in enumerate(NEIGHBOR_OFFSETS):
+        codes |= padded[1 + dx:1 + dx + rows, 1 + dy:1 + dy + cols] << bit
+    return codes
+
+
+def order_chain(
+    pixels: list[int],
+    section_of: dict[int, int],
+    section_index: int,
+    offsets: list[int],
+    padded_cols: int,
+) -> list[int]:
+    """
+    Orders a section's flat pixel indices into a chain. Starts at the pixel with the fewest
+    neighbors in the section and walks to an unvisited neighbor (orthogonal before diagonal).
+    Only at dead ends, e.g. after a branch, it jumps to the closest pixel seen but not yet visited
+    """
+    current = min(
+        pixels,
+        key=lambda p: sum(section_of.get(p + offset) == section_index for offset in offsets)
+    )
+
+    visited = {current}
+    chain = [current]
+    pending = []
+    while len(chain) < len(pixels):
+        candidates = [
+            current + offset for offset in offsets
+            if section_of.get(current + offset) == section_index and current + offset not in visited
+        ]
+        if candidates:
+            # offsets are ordered orthogonal first, so the first candidate is the closest
+            pending.extend(candidates[1:])
+            current = candidates[0]
+        else:
+            pending = [p for p in pending if p not in visited]
+            pending_array = np.array(pending)
+            row, col = divmod(current, padded_cols)
+            distances = (pending_array // padded_cols - row) ** 2 + (pending_array % padded_cols - col) ** 2
+            current = pending.pop(int(np.argmin(distances)))
+        visited.add(current)
+        chain.append(current)
+    return chain
+
+
 def sectionize(skeleton: cv.Mat):
     sections = defaultdict(list)
     last_section_index = 0
-    visited = set()
-    def neighbors(x,y):
-        all_neighbors = [(x-1,y), (x+1,y), (x,y-1), (x,y+1), (x-1,y-1), (x-1,y+1), (x+1,y-1), (x+1,y+1)]
-        return [
-            (nx, ny) for nx, ny in all_neighbors
-        ]
 
-    def is_intersection(x,y):
-        neighbor_diffs = [
-            (nx-x, ny-y) for nx, ny in neighbors(x, y) if 0 <= nx < skeleton.shape[0] and 0 <= ny < skeleton.shape[1] and skeleton[nx, ny] > 0
-        ]
+    # classify every skeleton pixel up front, then trace by flat index into the zero-padded
+    # image so neighbors never need bounds checks
+    junctions = JUNCTION_TABLE[neighborhood_codes(skeleton)]
+    padded_cols = skeleton.shape[1] + 2
+    skeleton_pixels = np.flatnonzero(np.pad(np.asarray(skeleton) > 0, 1))
+    on = set(skeleton_pixels.tolist())
+    is_junction = set(skeleton_pixels[np.pad(junctions, 1).ravel()[skeleton_pixels]].tolist())
+    offsets = [dx * padded_cols + dy for dx, dy in NEIGHBOR_OFFSETS]
+    visited = set()
 
-        # for every subset of 3
-        for v1, v2, v3 in combinations(neighbor_diffs, 3):
-            # if all 3 are orthogonal or opposite, return true
-            if all([
-                np.dot(v1, v2) <= 0,
-                np.dot(v1, v3) <= 0,
-                np.dot(v2, v3) <= 0
-            ]):
-                return True
-        return False
-
-    def dfs(x,y,section_index):
-        sections[section_index].append((y,x))
-        nonlocal last_section_index
-
-        for nx, ny in neighbors(x, y):
-            in_bounds = 0 <= nx < skeleton.shape[0] and 0 <= ny < skeleton.shape[1]
-            not_visited = (nx, ny) not in visited
-            if not (in_bounds and not_visited and skeleton[nx, ny] > 0):
+    # iterative version of a recursive dfs: each frame is (pixel, section, next neighbor to try)
+    for start in skeleton_pixels.tolist():
+        if start in visited:
+            continue
+        visited.add(start)
+        sections[last_section_index].append(start)
+        stack = [[start, last_section_index, 0]]
+        while stack:
+            frame = stack[-1]
+            pixel, section_index, k = frame
+            if k == 8:
+                stack.pop()
                 continue
+            frame[2] = k + 1
 
-            visited.add((nx, ny))
-            if is_intersection(x, y):
-                last_section_index+=1
-                dfs(nx, ny, last_section_index)
-            else:
-                dfs(nx, ny, section_index)
-    
-    for x in range(skeleton.shape[0]):
-        for y in range(skeleton.shape[1]):
-            if skeleton[x, y] > 0 and (x, y) not in visited:
-                visited.add((x, y))
-                dfs(x, y, last_section_index)
-                last_section_index+=1
-
-    # redo a bfs starting with leftmost point to make sure no lines cross within a section
-    reordered_sections = []
-    for section in sections.values():
-        section_set = set(section)
-        new_section = []
-        # find point with only 1 neighbor
-        first_point = min(
-            section,
-            key=lambda p: len([p2 for p2 in neighbors(*p) if p2 in section_set])
-        )
-        exploration = [first_point]
-        section_visited = set()
-        x, y = first_point
-        while len(exploration) > 0:
-            # get point in exploration with least distance to last point
-            i = np.argmin([np.linalg.norm(np.array(p) - np.array((x, y))) for p in exploration])
-            x, y = exploration.pop(i)
-            if (x, y) in section_visited:
+            neighbor = pixel + offsets[k]
+            if neighbor in visited or neighbor not in on:
                 continue
-            new_section.append((x, y))
-            section_visited.add((x, y))
-            for nx, ny in neighbors(x, y):
-                if (nx, ny) in section_set and (nx, ny) not in section_visited:
-                    exploration.append((nx, ny))
-        reordered_sections.append(new_section)
+            visited.add(neighbor)
+            if pixel in is_junction:
+                last_section_index += 1
+                section_index = last_section_index
+            sections[section_index].append(neighbor)
+            stack.append([neighbor, section_index, 0])
+        last_section_index += 1
+
+    # redo the walk starting from an end of each section to make sure no lines cross within a section
+    section_of = {
+        pixel: section_index
+        for section_index, pixels in sections.items()
+        for pixel in pixels
+    }
 
-    
+    reordered_sections = []
+    for section_index, pixels in sections.items():
+        chain = order_chain(pixels, section_of, section_index, offsets, padded_cols)
+        chain_rows, chain_cols = np.divmod(np.array(chain), padded_cols)
+        reordered_sections.append(list(zip((chain_cols - 1).tolist(), (chain_rows - 1).tolist())))
 
     return reordered_sections
 
-def linearize_section(section: list[tuple[int, int]], mse_threshold: float) -> list[tuple[int, int]]:
-    reduced_section = [section[0]]
-    last_added = 0
-    for i in range(1, len(section)-1):
-        # compute MSE for points last_added:i from linear approximation
-        prev_x, prev_y = section[last_added]
-        x, y = section[i]
-        if prev_x == x:
+def section_importance(section: list[tuple[int, int]]) -> np.ndarray:
+    """
+    Visvalingam-Whyatt effective area of every vertex: the triangle it forms with its neighbors
+    at the moment it would be removed, removing the least important vertex first. Endpoints are inf
+    """
+    n = len(section)
+    importance = np.full(n, np.inf)
+    if n <= 2:
+        return importance
+
+    prev_vertex = list(range(-1, n - 1))
+    next_vertex = list(range(1, n + 1))
+
+    def area(i: int) -> float:
+        (ax, ay), (bx, by), (cx, cy) = section[prev_vertex[i]], section[i], section[next_vertex[i]]
+        return abs((bx - ax) * (cy - ay) - (cx - ax) * (by - ay)) / 2
+
+    current_area = [0.0] * n
+    heap = []
+    for i in range(1, n - 1):
+        current_area[i] = area(i)
+        heap.append((current_area[i], i))
+    heapq.heapify(heap)
+
+    removed_area = 0.0
+    while heap:
+        a, i = heapq.heappop(heap)
+        # skip stale entries left behind when a neighbor's area changed
+        if a != current_area[i] or not np.isinf(importance[i]):
             continue
-        a = (y - prev_y) / (x - prev_x)
-        b = prev_y - a * prev_x
-        err = np.mean([(a*x + b - y)**2 for x, y in section[last_added:i]])
-        if err >= mse_threshold:
-            reduced_section.append(section[i])
-            last_added = i
-    reduced_section.append(section[-1])
-
-    return reduced_section
-
-def reduce_sections(sections: list[list[tuple[int, int]]], points_limit: int) -> list[tuple[int, int]]:
-    # binary search to find angle threshold that hits point limit exactly
-    # increasing the threshold will increase the number of points
-    lo = 0
-    hi = 10
-    for i in range(100):
-        mse_threshold = (lo + hi) / 2
-        linearized_sections = [linearize_section(section, mse_threshold) for section in sections]
-        n_points = sum(len(section) for section in linearized_sections)
-        if n_points  < points_limit:
-            hi = mse_threshold
-        elif n_points > points_limit:
-            lo = mse_threshold
-        else:
-            break
-    return linearized_sections
-    
+        # keep importance monotonic so ranks follow the removal order
+        removed_area = max(removed_area, a)
+        importance[i] = removed_area
+
+        p, q = prev_vertex[i], next_vertex[i]
+        next_vertex[p] = q
+        prev_vertex[q] = p
+        for j in (p, q):
+            if 0 < j < n - 1:
+                current_area[j] = area(j)
+                heapq.heappush(heap, (current_area[j], j))
+
+    return importance
+
+
+def rank_sections(sections: list[list[tuple[int, int]]]) -> list[np.ndarray]:
+    """
+    Global rank of every vertex across all sections, 0 being the most important.
+    Keeping the vertices ranked below n simplifies the drawing to exactly n points
+    """
+    importance = np.concatenate([section_importance(section) for section in sections])
+    ranks = np.empty(len(importance), dtype=np.int64)
+    ranks[np.argsort(-importance, kind="stable")] = np.arange(len(importance))
+    return np.split(ranks, np.cumsum([len(section) for section in sections])[:-1])
+
+
+def cut_sections(
+    sections: list[list[tuple[int, int]]],
+    ranks: list[np.ndarray],
+    points_limit: int,
+) -> list[list[tuple[int, int]]]:
+    """
+    Keeps the points_limit most important vertices. Section endpoints are always kept,
+    so the result only has more points when there are more endpoints than points_limit
+    """
+    reduced_sections = []
+    for section, section_ranks in zip(sections, ranks):
+        keep = section_ranks < points_limit
+        keep[[0, -1]] = True
+        reduced_sections.append([point for point, kept in zip(section, keep) if kept])
+    return reduced_sections
+
 
-def make_graph(reduced_sections: list[list[tuple[int,int]]], points_limit: int = 50) -> tuple[list[tuple[int, int]], dict[int, list[int]]]:
+def reduce_sections(sections: list[list[tuple[int, int]]], points_limit: int) -> list[list[tuple[int, int]]]:
+    return cut_sections(sections, rank_sections(sections), points_limit)
+
+
+def make_graph(
+    reduced_sections: list[list[tuple[int,int]]],
+    points_limit: int = 50,
+    join_radius: float = 5,
+) -> tuple[list[tuple[int, int]], dict[int, list[int]]]:
     """
-    Returns a list of points from an rgb image
+    Returns a list of points from an rgb image. Section endpoints closer than join_radius pixels are joined
     """
 
     vertices = []
@@ -159,13 +323,24 @@ def make_graph(reduced_sections: list[list[tuple[int,int]]], points_limit: int =
             if i > 0:
                 adjacencies[global_indices[section[i]]].append(global_indices[section[i-1]])
                 adjacencies[global_indices[section[i-1]]].append(global_indices[section[i]])
-    
-    for s1, s2 in combinations(reduced_sections, 2):
-        # check if endpoints are close, if so add edges
-        for i,j in product([0,-1],[0,-1]):
-            if np.linalg.norm(np.array(s1[i]) - np.array(s2[j])) < 5:
-                adjacencies[global_indices[s1[i]]].append(global_indices[s2[j]])
-                adjacencies[global_indices[s2[j]]].append(global_indices[s1[i]])
+
+    # endpoint 2*k is the start of section k and 2*k+1 its end
+    endpoints = [section[i] for section in reduced_sections for i in (0, -1)]
+    if len(endpoints) < 2:
+        return vertices, adjacencies
+
+    # find all close endpoint pairs at once with a KD-tree
+    pairs = cKDTree(np.array(endpoints)).query_pairs(join_radius, output_type="ndarray")
+    a, b = pairs[:, 0], pairs[:, 1]
+    distances = np.linalg.norm(np.array(endpoints)[a] - np.array(endpoints)[b], axis=1)
+    keep = (a // 2 != b // 2) & (distances < join_radius)
+    a, b = a[keep], b[keep]
+
+    # same order as checking every pair of sections in turn
+    for i in np.lexsort((b % 2, a % 2, b // 2, a // 2)).tolist():
+        p1, p2 = endpoints[a[i]], endpoints[b[i]]
+        adjacencies[global_indices[p1]].append(global_indices[p2])
+        adjacencies[global_indices[p2]].append(global_indices[p1])
 
     return vertices, adjacencies
 
@@ -220,53 +395,111 @@ def create_weighted_edgelist(vertices: list[tuple[int, int]], adjacencies: dict[
             edges_dict[tuple(sorted((i, j)))] = np.linalg.norm(np.array(vertices[i]) - np.array(vertices[j]))
     return [(i, j, w) for (i, j), w in edges_dict.items()]
 
-def points_from_img(img: cv.Mat, max_points: int = 50) -> list[tuple[int, int]]:
-    os.makedirs("debug", exist_ok=True)
-    cv.imwrite("debug/0_original.png", img)
-    skeleton = skeletonize(img)
-    cv.imwrite("debug/1_skeleton.png", skeleton)
-
-    sections = sectionize(skeleton)
-    canvas = np.zeros_like(img[:,:,:3])
-    for section in sections:
-        rand_color = np.random.randint(0, 255, 3).tolist()
-        for i in range(len(section)-1):
-            cv.line(canvas, section[i], section[i+1], rand_color, 1)
-    cv.imwrite("debug/2_sections.png", canvas)
-
-    reduced_sections = reduce_sections(sections, max_points)
-
-    vertices, adjacencies = make_graph(reduced_sections, max_points)
-
-    components = connected_components(vertices, adjacencies)
-    canvas2 = np.zeros_like(img[:,:,:3])
-    for component in components:
-        rand_color = np.random.randint(0, 255, 3).tolist()
-        for p in component:
-            cv.circle(canvas2, vertices[p], 2, rand_color, -1)
-    cv.imwrite("debug/3_components.png", canvas2)
+def write_debug_images(debug: dict[str, cv.Mat], path: str):
+    os.makedirs(path, exist_ok=True)
+    for name, image in debug.items():
+        cv.imwrite(os.path.join(path, f"{name}.png"), image)
 
-    combined_adjacency = combine_components(components, vertices, adjacencies)
-
-    edge_list = create_weighted_edgelist(vertices, combined_adjacency)
-
-    vertex_order = chinese_postman_problem(edge_list) 
-
-    canvas3 = np.zeros_like(img[:,:,:3])
-    for v1, v2 in pairwise(vertex_order):
-        cv.line(canvas3, vertices[v1], vertices[v2], (255, 255, 255), 1)
-    cv.imwrite("debug/4_chinese_postman.png", canvas3)
+def rank_img(
+    mask: cv.Mat,
+    debug: dict[str, cv.Mat] | None = None,
+) -> tuple[list[list[tuple[int, int]]], list[np.ndarray]]:
+    """
+    Image stage that doesn't depend on max_points: returns the sections of an ink mask's skeleton
+    and their simplification ranks, which cut_sections turns into any number of points.
+    Diagnostic images are only drawn when a debug dict is passed to collect them
+    """
+    with stage("skeletonize"):
+        skeleton = skeletonize(mask)
+    record_size("skeleton_pixels", np.count_nonzero(skeleton))
+    with stage("sectionize"):
+        sections = sectionize(skeleton)
+    record_size("sections", len(sections))
+
+    if debug is not None:
+        debug["1_skeleton"] = skeleton
+        canvas = np.zeros((*mask.shape[:2], 3), dtype=np.uint8)
+        for section in sections:
+            rand_color = np.random.randint(0, 255, 3).tolist()
+            for i in range(len(section)-1):
+                cv.line(canvas, section[i], section[i+1], rand_color, 1)
+        debug["2_sections"] = canvas
+
+    with stage("rank_sections"):
+        ranks = rank_sections(sections)
+    return sections, ranks
+
+def points_from_ranked(
+    sections: list[list[tuple[int, int]]],
+    ranks: list[np.ndarray],
+    img_shape: tuple[int, ...],
+    max_points: int = 50,
+    join_radius: float = 5,
+    deadline: float | None = None,
+    debug: dict[str, cv.Mat] | None = None,
+) -> list[tuple[int, int]]:
+    """
+    Cuts ranked sections down to max_points and orders them into one continuous path.
+    join_radius is in pixels of the ranked mask, see working_radius
+    """
+    with stage("reduce_sections"):
+        reduced_sections = cut_sections(sections, ranks, max_points)
+
+    with stage("make_graph"):
+        vertices, adjacencies = make_graph(reduced_sections, max_points, join_radius)
+        components = connected_components(vertices, adjacencies)
+    if debug is not None:
+        canvas2 = np.zeros((*img_shape[:2], 3), dtype=np.uint8)
+        for component in components:
+            rand_color = np.random.randint(0, 255, 3).tolist()
+            for p in component:
+                cv.circle(canvas2, vertices[p], 2, rand_color, -1)
+        debug["3_components"] = canvas2
+
+    with stage("make_graph"):
+        combined_adjacency = combine_components(components, vertices, adjacencies)
+        edge_list = create_weighted_edgelist(vertices, combined_adjacency)
+    record_size("vertices", len(vertices))
+    record_size("edges", len(edge_list))
+
+    with stage("chinese_postman"):
+        vertex_order = chinese_postman_problem(edge_list, deadline=deadline)
+
+    if debug is not None:
+        canvas3 = np.zeros((*img_shape[:2], 3), dtype=np.uint8)
+        for v1, v2 in pairwise(vertex_order):
+            cv.line(canvas3, vertices[v1], vertices[v2], (255, 255, 255), 1)
+        debug["4_chinese_postman"] = canvas3
     
     return [
         vertices[i] for i in vertex_order
     ]
 
+def points_from_img(
+    img: cv.Mat,
+    max_points: int = 50,
+    join_radius: float = JOIN_RADIUS,
+    deadline: float | None = None,
+    debug: dict[str, cv.Mat] | None = None,
+) -> list[tuple[float, float]]:
+    """
+    Pass a dict as debug to get the diagnostic images back by name. join_radius is in pixels of img
+    """
+    mask, offset, scale = ingest(img, working_size(max_points), debug)
+    sections, ranks = rank_img(mask, debug)
+    radius = working_radius(join_radius, scale)
+    points = points_from_ranked(sections, ranks, mask.shape, max_points, radius, deadline, debug)
+    return to_original(points, offset, scale)
+
 if __name__ == "__main__":
     img = cv.imread(f"{CURRENT_FILEPATH}/inverted_circle.png")
     canvas = np.zeros_like(img)
 
-    for v1, v2 in pairwise(points_from_img(img)):
-        cv.line(canvas, v1, v2, (0, 255, 0), 2)
+    debug = {}
+    points = points_from_img(img, debug=debug)
+    write_debug_images(debug, "debug")
+    for v1, v2 in pairwise(points):
+        cv.line(canvas, tuple(map(round, v1)), tuple(map(round, v2)), (0, 255, 0), 2)
         cv.imshow("canvas", canvas)
         cv.waitKey(10)
 
@@ -0,0 +1,141 @@
+import asyncio
+import os
+import time
+import uuid
+
+from fastapi import HTTPException
+
+from workers import RETRY_AFTER
+
+# seconds a finished job's events stay available
+JOB_TTL = float(os.getenv("JOB_TTL", 300))
+# seconds a running job may go without listeners, e.g. while an EventSource reconnects, before it is cancelled
+JOB_IDLE_TIMEOUT = float(os.getenv("JOB_IDLE_TIMEOUT", 30))
+# jobs kept at once, running or finished, before new ones are turned away
+MAX_JOBS = int(os.getenv("MAX_JOBS", 1000))
+
+
+class Job:
+    '''
+    Background pipeline run whose stage results are kept as a list of (event, data) so
+    clients can follow it from the start or resume after a dropped connection
+    '''
+
+    def __init__(self, idle_timeout: float):
+        self.id = uuid.uuid4().hex
+        self.idle_timeout = idle_timeout
+        self.events: list[tuple[str, dict]] = []
+        self.done = False
+        self.listeners = 0
+        # when the job finished or last lost its listeners
+        self.idle_since = time.monotonic()
+        self.task: asyncio.Task | None = None
+        self._changed = asyncio.Event()
+        self._watch_idle()
+
+    def emit(self, event: str, data: dict):
+        self.events.append((event, data))
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def finish(self):
+        self.done = True
+        self.idle_since = time.monotonic()
+        self.emit("done", {})
+
+    def cancel(self):
+        if self.task is not None and not self.done:
+            self.task.cancel()
+
+    def _watch_idle(self):
+        asyncio.get_running_loop().call_later(self.idle_timeout, self._cancel_if_idle)
+
+    def _cancel_if_idle(self):
+        if self.done or self.listeners:
+            return
+        idle = time.monotonic() - self.idle_since
+        if idle >= self.idle_timeout:
+            self.cancel()
+        else:
+            # listened to again in the meantime
+            asyncio.get_running_loop().call_later(self.idle_timeout - idle, self._cancel_if_idle)
+
+    async def follow(self, start: int = 0):
+        '''
+        Yields (index, event, data) from event start on until the job is done. A job that
+        loses its last listener keeps running for idle_timeout seconds so clients can reconnect
+        '''
+        self.listeners += 1
+        try:
+            index = start
+            while True:
+                changed = self._changed
+                while index < len(self.events):
+                    event, data = self.events[index]
+                    yield index, event, data
+                    index += 1
+                if self.done:
+                    return
+                await changed.wait()
+        finally:
+            self.listeners -= 1
+            if self.listeners == 0:
+                self.idle_since = time.monotonic()
+                self._watch_idle()
+
+
+class JobStore:
+    '''
+    Running and recently finished jobs by id
+    '''
+
+    def __init__(self, ttl: float, max_jobs: int, idle_timeout: float):
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self.idle_timeout = idle_timeout
+        self._jobs: dict[str, Job] = {}
+
+    def start(self, run) -> Job:
+        '''
+        Starts run(job) as a task. It reports progress with job.emit, the job is finished when it returns.
+        Raises 503 with Retry-After when max_jobs are kept
+        '''
+        self.expire()
+        if len(self._jobs) >= self.max_jobs:
+            raise HTTPException(
+                status_code=503,
+                detail="server busy",
+                headers={"Retry-After": str(RETRY_AFTER)},
+            )
+        job = Job(self.idle_timeout)
+        self._jobs[job.id] = job
+
+        async def task():
+            try:
+                await run(job)
+            except asyncio.CancelledError:
+                job.emit("cancelled", {})
+            finally:
+                job.finish()
+
+        job.task = asyncio.create_task(task())
+        return job
+
+    def get(self, job_id: str) -> Job:
+        self.expire()
+        job = self._jobs.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="job not found")
+        return job
+
+    def expire(self):
+        '''
+        Drops jobs that finished more than ttl seconds ago
+        '''
+        now = time.monotonic()
+        for job_id, job in list(self._jobs.items()):
+            if job.done and not job.listeners and now - job.idle_since >= self.ttl:
+                del self._jobs[job_id]
+
+
+jobs = JobStore(JOB_TTL, MAX_JOBS, JOB_IDLE_TIMEOUT)
@@ -1,13 +1,32 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 from dotenv import load_dotenv
 load_dotenv()
 
+import metrics
 from hard_coded_text_pts import text_pts
+from pipeline import warm_up
+from src.matrix import get_tiles
 from routers import maps
+from workers import pool
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # converts and tiles the map here, once, if that wasn't done yet. Otherwise every
+    # worker would start on the same GraphML at the same time
+    get_tiles()
+    # every worker process loads the street graph once, up front
+    pool.start(initializer=warm_up)
+    yield
+    pool.shutdown()
 
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan)
 
 origins = ["*"]
 
@@ -40,3 +59,9 @@ def generate_points(text: str):
 @app.get("/")
 async def root() -> dict[str, str]:
     return {"message": "hello"}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    # Prometheus text exposition format
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
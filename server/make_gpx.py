@@ -1,29 +1,92 @@
-import gpxpy.gpx
 import base64
+import gzip
 
-def make_gpx(coords: list[tuple[int,int]]):
-    gpx_obj = gpxpy.gpx.GPX()
+import numpy as np
 
-    gpx_track  = gpxpy.gpx.GPXTrack()
+GPX_HEADER = (
+    b'<?xml version="1.0" encoding="UTF-8"?>\n'
+    b'<gpx xmlns="http://www.topografix.com/GPX/1/1" '
+    b'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+    b'xsi:schemaLocation="http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd" '
+    b'version="1.1" creator="LAMaps">\n'
+    b'  <trk>\n'
+    b'    <trkseg>\n'
+)
+GPX_FOOTER = (
+    b'    </trkseg>\n'
+    b'  </trk>\n'
+    b'</gpx>\n'
+)
+# 7 decimals is about a centimeter
+DECIMALS = 7
 
-    gpx_obj.tracks.append(gpx_track)
 
-    # Create first segment in our GPX track:
-    gpx_segment = gpxpy.gpx.GPXTrackSegment()
-    gpx_track.segments.append(gpx_segment)
+def decimal_chars(values: np.ndarray, out: np.ndarray, used: np.ndarray, decimals: int = DECIMALS):
+    '''
+    Writes degrees (|value| < 1000) as fixed point ascii into the 5 + decimals columns of out:
+    sign, 3 integer digits, point and decimals. used masks out the sign of positive values
+    and the integer part's leading zeros
+    '''
+    q = np.round(np.abs(values) * 10 ** decimals).astype(np.int64)
+    integer, fraction = np.divmod(q, 10 ** decimals)
+    integer = integer.astype(np.int32)
+    fraction = fraction.astype(np.int32)
 
-    # Create points:
-    for lat, lon in coords:
-        gpx_segment.points.append(gpxpy.gpx.GPXTrackPoint(lat, lon))
+    out[:, 0] = ord("-")
+    for k in range(3):
+        out[:, 3 - k] = integer % 10 + ord("0")
+        integer //= 10
+    out[:, 4] = ord(".")
+    for k in range(decimals):
+        out[:, 4 + decimals - k] = fraction % 10 + ord("0")
+        fraction //= 10
 
-    return gpx_obj.to_xml()
+    used[:, 0] = values < 0
+    used[:, 1] = q >= 100 * 10 ** decimals
+    used[:, 2] = q >= 10 * 10 ** decimals
 
-def b64encode(string: str):
-    encoded_bytes = base64.b64encode(string.encode("utf-8"))
-    return encoded_bytes.decode("utf-8")
+
+def gpx_bytes(coords, compress: bool = False) -> bytes:
+    '''
+    GPX track of lat, lon points. All trkpt lines are written at once into a table of fixed width
+    character columns, instead of building an xml tree, and optionally gzipped
+    '''
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    number_width = 5 + DECIMALS
+    # literal text, or which coordinate goes there
+    parts = [b'      <trkpt lat="', 0, b'" lon="', 1, b'"/>\n']
+
+    width = sum(number_width if isinstance(p, int) else len(p) for p in parts)
+    chars = np.empty((len(coords), width), dtype=np.uint8)
+    used = np.ones((len(coords), width), dtype=bool)
+    column = 0
+    for part in parts:
+        if isinstance(part, int):
+            columns = slice(column, column + number_width)
+            decimal_chars(coords[:, part], chars[:, columns], used[:, columns])
+            column += number_width
+        else:
+            chars[:, column:column + len(part)] = np.frombuffer(part, dtype=np.uint8)
+            column += len(part)
+
+    data = b"".join([GPX_HEADER, chars[used].tobytes(), GPX_FOOTER])
+    if compress:
+        # fixed mtime keeps the output identical between runs
+        data = gzip.compress(data, compresslevel=6, mtime=0)
+    return data
+
+
+def make_gpx(coords: list[tuple[int,int]]) -> str:
+    return gpx_bytes(coords).decode("ascii")
+
+
+def b64encode(data: str | bytes):
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return base64.b64encode(data).decode("utf-8")
 
 if __name__ == "__main__":
     points = [[35.73285652173913,-117.67788183516483],[35.71836376811594,-117.6595668168498],[35.240102898550724,-117.51304667032966],[34.42850869565217,-116.853706010989],[34.022711594202896,-116.17605033333332],[33.84879855072464,-115.58996974725274],[33.80532028985507,-115.31524447252747],[33.79082753623188,-115.11377927106227],[33.77633478260869,-114.87568403296703],[33.79082753623188,-114.67421883150182],[33.80532028985507,-114.5460137032967],[33.87778405797101,-114.16139831868131],[34.16763913043478,-113.4471126043956],[34.761842028985505,-112.73282689010988],[35.84879855072464,-112.27495143223443],[36.93575507246376,-112.49473165201465],[37.68937826086956,-113.13575729304029],[38.10966811594203,-113.90498806227106],[38.225610144927536,-114.3445485018315],[38.25459565217391,-114.52769868498167],[38.2690884057971,-114.65590381318681],[38.28358115942029,-115.02220417948718],[38.2690884057971,-115.20535436263735],[38.25459565217391,-115.33355949084249],[38.21111739130434,-115.62659978388278],[38.08068260869565,-116.12110527838827],[37.71836376811594,-116.79876095604395],[36.95024782608695,-117.43978659706958],[36.93575507246376,-117.43978659706958],[36.921262318840576,-117.38484154212453],[36.95024782608695,-117.43978659706958],[36.921262318840576,-117.43978659706958],[36.93575507246376,-117.43978659706958],[36.921262318840576,-117.38484154212453],[36.921262318840576,-117.43978659706958],[35.73285652173913,-117.67788183516483]]
     gpx_str = make_gpx(points)
     with open("test.gpx", "w") as f:
-        f.write(gpx_str)
\ No newline at end of file
+        f.write(gpx_str)
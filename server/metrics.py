@@ -0,0 +1,115 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (10, 30, 100, 300, 1000, 3000, 10_000, 30_000, 100_000, 300_000, 1_000_000)
+
+
+class Trace:
+    '''
+    Stage durations in seconds and input sizes of one request, in the order they were recorded
+    '''
+
+    def __init__(self):
+        self.timings: dict[str, float] = {}
+        self.sizes: dict[str, int] = {}
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.timings.items())
+
+
+_current_trace: ContextVar[Trace | None] = ContextVar("current_trace", default=None)
+
+
+@contextmanager
+def stage(name: str):
+    '''
+    Adds the time spent in the block to the running trace, if any
+    '''
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.timings[name] = trace.timings.get(name, 0.0) + time.perf_counter() - start
+
+
+def record_size(name: str, size: int):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.sizes[name] = int(size)
+
+
+def traced(fn, *args, **kwargs) -> tuple[object, Trace]:
+    '''
+    Calls fn with a fresh trace running and returns its result along with the trace.
+    Picklable, so it can be submitted to a worker process
+    '''
+    trace = Trace()
+    token = _current_trace.set(trace)
+    try:
+        return fn(*args, **kwargs), trace
+    finally:
+        _current_trace.reset(token)
+
+
+class Histogram:
+    '''
+    Cumulative-bucket histogram per label value, rendered in Prometheus text format
+    '''
+
+    def __init__(self, name: str, help: str, label: str, buckets: tuple[float, ...]):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self._series: dict[str, tuple[list[int], list[float]]] = {}
+
+    def observe(self, label_value: str, value: float):
+        # counts per bucket plus +Inf, and [sum, count]
+        counts, totals = self._series.setdefault(label_value, ([0] * (len(self.buckets) + 1), [0.0, 0]))
+        counts[bisect_left(self.buckets, value)] += 1
+        totals[0] += value
+        totals[1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_value, (counts, (total, count)) in sorted(self._series.items()):
+            label = f'{self.label}="{label_value}"'
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{label}}} {total}")
+            lines.append(f"{self.name}_count{{{label}}} {count}")
+        return lines
+
+
+stage_seconds = Histogram(
+    "lamaps_stage_seconds", "Time spent in each pipeline stage.", "stage", LATENCY_BUCKETS,
+)
+stage_size = Histogram(
+    "lamaps_stage_size", "Size of each stage's input or output, e.g. pixels, sections, vertices.", "quantity", SIZE_BUCKETS,
+)
+request_seconds = Histogram(
+    "lamaps_request_seconds", "End to end request time by outcome.", "outcome", LATENCY_BUCKETS,
+)
+
+
+def observe(trace: Trace):
+    for name, seconds in trace.timings.items():
+        stage_seconds.observe(name, seconds)
+    for name, size in trace.sizes.items():
+        stage_size.observe(name, size)
+
+
+def render() -> str:
+    lines = []
+    for histogram in (request_seconds, stage_seconds, stage_size):
+        lines.extend(histogram.render())
+    return "\n".join(lines) + "\n"
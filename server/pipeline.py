@@ -0,0 +1,258 @@
+import base64
+import os
+import time
+import uuid
+
+import cv2 as cv
+import numpy as np
+
+from caching import TieredCache, content_key
+from img_to_points import (
+    JOIN_RADIUS,
+    ingest,
+    points_from_ranked,
+    rank_img,
+    to_original,
+    working_radius,
+    working_size,
+    write_debug_images,
+)
+from formats import encode_points
+from make_gpx import b64encode, gpx_bytes
+from metrics import stage
+from src.fitting import RoadMatch
+from src.matrix import fit_placements, follow_streets, get_region, get_tiles, mercator_transformers, scale_and_place
+
+
+# image stage results don't depend on the bounds, so panning the map reuses them.
+# Files under IMAGE_CACHE_DIR are shared by every worker, an empty value keeps them in memory only
+image_cache = TieredCache(
+    memory_bytes=int(os.getenv("IMAGE_CACHE_BYTES", 32 * 1024 * 1024)),
+    disk_path=os.getenv("IMAGE_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "images")),
+    disk_bytes=int(os.getenv("IMAGE_CACHE_DISK_BYTES", 512 * 1024 * 1024)),
+)
+
+# when set, every request writes its diagnostic images to a new directory under this one
+DEBUG_DIR = os.getenv("DEBUG_DIR")
+
+
+def check_deadline(deadline: float | None):
+    '''
+    Raises TimeoutError once the request's deadline (a time.time() timestamp) has passed
+    '''
+    if deadline is not None and time.time() > deadline:
+        raise TimeoutError("request timed out")
+
+
+def warm_up():
+    '''
+    Worker initializer: opens the tiled graph and sets up the projections once so requests don't pay for it
+    '''
+    get_tiles()
+    mercator_transformers()
+
+
+def pixel_points(
+    image_bytes: bytes,
+    max_points: int,
+    deadline: float | None = None,
+    debug: dict[str, cv.Mat] | None = None,
+) -> tuple[list[tuple[float, float]], tuple[int, ...]]:
+    '''
+    Ordered pixel-space points of a drawing and its image shape, through image_cache.
+    The CV work runs on the drawing cropped and scaled to a working size for max_points, its ranking
+    is cached by image and working size so other max_points skip the CV work too.
+    Passing a debug dict skips the cache lookups so every diagnostic image gets drawn
+    '''
+    image_key = content_key(image_bytes)
+    points_key = content_key(image_key, max_points)
+    with stage("image_cache"):
+        cached = image_cache.get(points_key) if debug is None else None
+    if cached is not None:
+        return cached
+
+    size = working_size(max_points)
+    ranked_key = content_key(image_key, size)
+    ranked = image_cache.get(ranked_key) if debug is None else None
+    if ranked is None:
+        with stage("decode"):
+            # decodes straight from the upload's buffer
+            cv_img = cv.imdecode(np.frombuffer(image_bytes, np.uint8), cv.IMREAD_UNCHANGED)
+        if cv_img is None:
+            raise ValueError("could not decode image")
+        check_deadline(deadline)
+        mask, offset, scale = ingest(cv_img, size, debug)
+        sections, ranks = rank_img(mask, debug)
+        ranked = (sections, ranks, mask.shape, offset, scale, cv_img.shape)
+        image_cache.set(ranked_key, ranked)
+        check_deadline(deadline)
+
+    sections, ranks, mask_shape, offset, scale, img_shape = ranked
+    join_radius = working_radius(JOIN_RADIUS, scale)
+    points = points_from_ranked(sections, ranks, mask_shape, max_points, join_radius, deadline, debug)
+    points = to_original(points, offset, scale)
+    image_cache.set(points_key, (points, img_shape))
+    return points, img_shape
+
+
+def snap_points(
+    gps_coords: np.ndarray,
+    ne: list[float, float],
+    sw: list[float, float],
+    placements: int = 1,
+    deadline: float | None = None,
+) -> list[RoadMatch]:
+    '''
+    Fits lat, lon points from scale_and_place onto the streets around the bounds, best placement first
+    '''
+    with stage("get_region"):
+        street_graph = get_region(ne, sw)
+    check_deadline(deadline)
+    with stage("fit_to_map"):
+        return fit_placements(gps_coords, placements, street_graph=street_graph)
+
+
+def route_points(
+    road_match: RoadMatch,
+    ne: list[float, float],
+    sw: list[float, float],
+    deadline: float | None = None,
+) -> np.ndarray:
+    '''
+    Street route through a match snap_points made with the same bounds, as lat, lon points
+    '''
+    check_deadline(deadline)
+    # the region is still cached from snap_points
+    street_graph = get_region(ne, sw)
+    with stage("follow_streets"):
+        return follow_streets(road_match, street_graph)
+
+
+def encode_response(
+    gps_coords: np.ndarray,
+    alternatives: list[dict],
+    output: str = "json",
+    compress: bool = False,
+    placements: int = 1,
+) -> dict | bytes:
+    '''
+    The final lat, lon points as coordinatize returns them. alternatives are the fitted
+    placements' {"points", "error", "iterations"}, listed in the json when placements > 1
+    '''
+    if output != "json":
+        with stage("encode"):
+            return encode_points(gps_coords, output, compress)
+
+    with stage("make_gpx"):
+        gpx_file = gpx_bytes(gps_coords)
+
+    response = {"points": gps_coords.tolist(), "gpxFile": b64encode(gpx_file)}
+    if placements > 1 and alternatives:
+        response["placements"] = [
+            {**alternative, "points": alternative["points"].tolist()}
+            for alternative in alternatives
+        ]
+    return response
+
+
+def fit_alternatives(
+    gps_coords: np.ndarray,
+    ne: list[float, float],
+    sw: list[float, float],
+    route: bool = False,
+    placements: int = 1,
+    deadline: float | None = None,
+    on_event=None,
+) -> list[dict]:
+    '''
+    Fits scale_and_place points onto the streets and routes every placement if route is set,
+    returning their {"points", "error", "iterations"} best first. on_event(event, data) gets
+    the "snapped" placements, then a "routed" polyline per placement as each one finishes
+    '''
+    road_matches = snap_points(gps_coords, ne, sw, placements, deadline)
+    if on_event is not None:
+        on_event("snapped", {
+            "placements": [
+                {"points": m.latlon.tolist(), "error": m.error, "iterations": m.iterations}
+                for m in road_matches
+            ],
+        })
+
+    alternatives = []
+    for i, road_match in enumerate(road_matches):
+        latlon = road_match.latlon
+        if route:
+            latlon = route_points(road_match, ne, sw, deadline)
+            if on_event is not None:
+                on_event("routed", {"placement": i, "points": latlon.tolist()})
+        alternatives.append({"points": latlon, "error": road_match.error, "iterations": road_match.iterations})
+    return alternatives
+
+
+def place(
+    points: list[tuple[int, int]],
+    img_shape: tuple[int, ...],
+    ne: list[float, float],
+    sw: list[float, float],
+    snap: bool = False,
+    route: bool = False,
+    output: str = "json",
+    compress: bool = False,
+    placements: int = 1,
+    deadline: float | None = None,
+    on_event=None,
+) -> dict | bytes:
+    '''
+    Bounds dependent half of the pipeline: puts pixel points from pixel_points on the map,
+    optionally fits and routes them along streets, and encodes the result like coordinatize.
+    With placements > 1 the json also lists that many alternative fits, best first, under "placements".
+    on_event(event, data) follows the stages: "placed", then fit_alternatives' events
+    '''
+    check_deadline(deadline)
+    with stage("scale_and_place"):
+        gps_coords = scale_and_place(points, ne, sw, img_shape[0], img_shape[1])
+    if on_event is not None:
+        on_event("placed", {"points": gps_coords.tolist()})
+
+    alternatives = []
+    if snap or route:
+        alternatives = fit_alternatives(
+            gps_coords, ne, sw, route, placements if output == "json" else 1, deadline, on_event,
+        )
+        gps_coords = alternatives[0]["points"]
+
+    return encode_response(gps_coords, alternatives, output, compress, placements)
+
+
+def coordinatize(
+    image_bytes: bytes,
+    ne: list[float, float],
+    sw: list[float, float],
+    max_points: int = 50,
+    snap: bool = False,
+    route: bool = False,
+    debug: bool = False,
+    output: str = "json",
+    compress: bool = False,
+    placements: int = 1,
+    deadline: float | None = None,
+) -> dict | bytes:
+    '''
+    Runs the whole drawing to route pipeline for one request. CPU bound, meant to run in a worker.
+    Returns the json response, or the route encoded as one of formats.MEDIA_TYPES when output names one,
+    gzipped if compress is set. With debug the json has the diagnostic images base64 PNG encoded under "debug".
+    Raises ValueError for unusable input and TimeoutError once deadline passes
+    '''
+    debug_images = {} if debug or DEBUG_DIR else None
+    points, img_shape = pixel_points(image_bytes, max_points, deadline, debug_images)
+    if DEBUG_DIR:
+        request_dir = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        write_debug_images(debug_images, os.path.join(DEBUG_DIR, request_dir))
+
+    response = place(points, img_shape, ne, sw, snap, route, output, compress, placements, deadline)
+    if debug and output == "json":
+        response["debug"] = {
+            name: base64.b64encode(cv.imencode(".png", image)[1]).decode("ascii")
+            for name, image in debug_images.items()
+        }
+    return response
@@ -1,37 +1,338 @@
+import asyncio
+import contextlib
 import json
+import os
+import time
+import traceback
 from typing import Annotated
 
-import cv2 as cv
-import numpy as np
-from fastapi import APIRouter, File, Form, UploadFile
-from img_to_points import points_from_img
-from make_gpx import b64encode, make_gpx
-from src.matrix import fit_to_map, scale_and_place
+from fastapi import APIRouter, File, Form, Header, HTTPException, Response, UploadFile
+from fastapi.responses import StreamingResponse
+from caching import TieredCache, content_key
+from formats import MEDIA_TYPES
+from jobs import Job, jobs
+from metrics import observe, request_seconds, traced
+from pipeline import coordinatize, pixel_points, place
+from workers import pool
 
 router = APIRouter()
 
+# finished responses by image and parameters, RESPONSE_CACHE_DIR adds a tier that survives restarts
+response_cache = TieredCache(
+    memory_bytes=int(os.getenv("RESPONSE_CACHE_BYTES", 64 * 1024 * 1024)),
+    disk_path=os.getenv("RESPONSE_CACHE_DIR"),
+    disk_bytes=int(os.getenv("RESPONSE_CACHE_DISK_BYTES", 1024 * 1024 * 1024)),
+)
+
+# alternative fits a request may ask for, each widens the placement search
+MAX_PLACEMENTS = int(os.getenv("MAX_PLACEMENTS", 10))
+# uploads larger than this are refused before any decoding
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 16 * 1024 * 1024))
+
+async def read_image(image: UploadFile) -> bytes:
+    '''
+    Upload's bytes, raises 413 past MAX_UPLOAD_BYTES
+    '''
+    if image.size is None or image.size <= MAX_UPLOAD_BYTES:
+        image_bytes = await image.read(MAX_UPLOAD_BYTES + 1)
+        if len(image_bytes) <= MAX_UPLOAD_BYTES:
+            return image_bytes
+    raise HTTPException(status_code=413, detail=f"image larger than {MAX_UPLOAD_BYTES} bytes")
+
+def parse_bounds(bounds_dict: dict) -> tuple[list[float], list[float]]:
+    '''
+    North east and south west lat, lon corners of Leaflet's LatLngBounds json
+    '''
+    ne = [bounds_dict["_northEast"]["lat"], bounds_dict["_northEast"]["lng"]]
+    sw = [bounds_dict["_southWest"]["lat"], bounds_dict["_southWest"]["lng"]]
+    return ne, sw
+
+def parse_placements(placements: str) -> int:
+    '''
+    Number of placements asked for, raises 422 outside 1 to MAX_PLACEMENTS
+    '''
+    try:
+        count = int(placements)
+    except ValueError:
+        count = 0
+    if not 1 <= count <= MAX_PLACEMENTS:
+        raise HTTPException(status_code=422, detail=f"placements must be between 1 and {MAX_PLACEMENTS}")
+    return count
+
+async def run(fn, *args, limit: asyncio.Semaphore | None = None, on_event=None, **kwargs):
+    '''
+    Runs fn traced in the worker pool and records its stage timings. limit caps how many runs
+    of one request are queued at once, on_event follows fn's events as in pool.run_with_events
+    '''
+    async with limit or contextlib.nullcontext():
+        if on_event is None:
+            result, trace = await pool.run(traced, fn, *args, **kwargs)
+        else:
+            result, trace = await pool.run_with_events(traced, fn, *args, on_event=on_event, **kwargs)
+    observe(trace)
+    return result
+
+def response_key(
+    image_bytes: bytes,
+    ne,
+    sw,
+    max_points: int,
+    snap: bool,
+    route: bool,
+    output: str,
+    compress: bool,
+    placements: int,
+) -> str:
+    return content_key(
+        image_bytes,
+        tuple(round(float(c), 7) for c in (ne[0], sw[0], ne[1], sw[1])),
+        max_points,
+        snap,
+        route,
+        output,
+        compress,
+        placements,
+    )
+
 @router.post("/coordinatize")
 async def img_to_points(
+    http_response: Response,
     bounds: Annotated[str, Form(...)],
-    max_points: Annotated[str, Form(...)] = 50,
+    max_points: Annotated[str, Form(...)] = '50',
     image: UploadFile = File(optional=True),
     snap: Annotated[str, Form(...)] = 'false',
+    route: Annotated[str, Form(...)] = 'false',
+    debug: Annotated[str, Form(...)] = 'false',
+    output: Annotated[str, Form(...)] = 'json',
+    placements: Annotated[str, Form(...)] = '1',
+    accept_encoding: Annotated[str | None, Header()] = None,
 ):
-    bounds_dict = json.loads(bounds)
-    north = bounds_dict["_northEast"]["lat"]
-    south = bounds_dict["_southWest"]["lat"]
-    east = bounds_dict["_northEast"]["lng"]
-    west = bounds_dict["_southWest"]["lng"]
-    cv_img = cv.imdecode(
-        np.fromstring(image.file.read(), np.uint8), cv.IMREAD_UNCHANGED
+    '''
+    output is "json" for points and a base64 GPX file, or one of formats.MEDIA_TYPES for just the
+    route as the response body, gzipped for clients that accept it.
+    placements > 1 adds that many alternative fits with their error to snapped or routed json responses
+    '''
+    start = time.perf_counter()
+    if output != "json" and output not in MEDIA_TYPES:
+        raise HTTPException(status_code=422, detail=f"output must be json or one of {', '.join(MEDIA_TYPES)}")
+    compress = output != "json" and "gzip" in (accept_encoding or "")
+
+    ne, sw = parse_bounds(json.loads(bounds))
+    placements = parse_placements(placements)
+    image_bytes = await read_image(image)
+
+    cache_key = response_key(
+        image_bytes, ne, sw, int(max_points), snap == "true", route == "true", output, compress, placements,
     )
-    points = points_from_img(cv_img, int(max_points))
-    gps_coords = scale_and_place(points, [north, east], [south, west], cv_img.shape[0], cv_img.shape[1])
+    # debug responses carry the diagnostic images, so they are always computed fresh
+    debug = debug == "true"
+    cached = response_cache.get(cache_key) if not debug else None
+    if cached is not None:
+        elapsed = time.perf_counter() - start
+        request_seconds.observe("cached", elapsed)
+        return reply(cached, output, compress, http_response, f"cache;desc=hit, total;dur={elapsed * 1000:.1f}")
+
+    try:
+        response, trace = await pool.run(
+            traced,
+            coordinatize,
+            image_bytes,
+            ne,
+            sw,
+            max_points=int(max_points),
+            snap=snap == "true",
+            route=route == "true",
+            debug=debug,
+            output=output,
+            compress=compress,
+            placements=placements,
+        )
+    except ValueError as e:
+        request_seconds.observe("invalid", time.perf_counter() - start)
+        raise HTTPException(status_code=422, detail=str(e))
+    except HTTPException as e:
+        request_seconds.observe("busy" if e.status_code == 503 else "timeout", time.perf_counter() - start)
+        raise
+
+    elapsed = time.perf_counter() - start
+    observe(trace)
+    request_seconds.observe("ok", elapsed)
+
+    if not debug:
+        response_cache.set(cache_key, response)
+    return reply(response, output, compress, http_response, f"{trace.server_timing()}, total;dur={elapsed * 1000:.1f}")
+
+def reply(response: dict | bytes, output: str, compressed: bool, http_response: Response, server_timing: str):
+    if output == "json":
+        http_response.headers["Server-Timing"] = server_timing
+        return response
+    headers = {"Server-Timing": server_timing, "Vary": "Accept-Encoding"}
+    if compressed:
+        headers["Content-Encoding"] = "gzip"
+    return Response(response, media_type=MEDIA_TYPES[output], headers=headers)
+
+@router.post("/coordinatize/batch")
+async def batch_img_to_points(
+    bounds: Annotated[str, Form(...)],
+    images: list[UploadFile] = File(...),
+    max_points: Annotated[str, Form(...)] = '50',
+    snap: Annotated[str, Form(...)] = 'false',
+    route: Annotated[str, Form(...)] = 'false',
+    placements: Annotated[str, Form(...)] = '1',
+):
+    '''
+    Places every image at every one of its bounds. bounds is a json list holding a list of
+    Leaflet bounds per image, or one flat list of bounds used for all images.
+    Each image is processed once, then its placements run in parallel. Results stream back as
+    newline delimited json in the order they finish, each line tagged with its "image" and "bounds"
+    indices and holding either the single endpoint's json response or an "error"
+    '''
+    bounds_list = json.loads(bounds)
+    if all(isinstance(b, dict) for b in bounds_list):
+        bounds_list = [bounds_list] * len(images)
+    if len(bounds_list) != len(images):
+        raise HTTPException(status_code=422, detail="bounds needs one list of bounds per image")
+    image_bounds = [[parse_bounds(b) for b in per_image] for per_image in bounds_list]
+    image_contents = [await read_image(image) for image in images]
+    max_points = int(max_points)
+    snap = snap == "true"
+    route = route == "true"
+    placements = parse_placements(placements)
+
+    # keeps the batch from filling up the pool's queue on its own
+    limit = asyncio.Semaphore(max(pool.workers, 1))
+    results = asyncio.Queue()
+    # pixel_points per distinct image, shared by images uploaded more than once
+    image_jobs: dict[str, asyncio.Task] = {}
+
+    def image_job(image_bytes: bytes) -> asyncio.Task:
+        image_key = content_key(image_bytes)
+        if image_key not in image_jobs:
+            image_jobs[image_key] = asyncio.create_task(run(pixel_points, image_bytes, max_points, limit=limit))
+        return image_jobs[image_key]
+
+    async def place_one(i: int, j: int, image_bytes: bytes):
+        ne, sw = image_bounds[i][j]
+        line = {"image": i, "bounds": j}
+        cache_key = response_key(image_bytes, ne, sw, max_points, snap, route, "json", False, placements)
+        try:
+            response = response_cache.get(cache_key)
+            if response is None:
+                points, img_shape = await image_job(image_bytes)
+                response = await run(
+                    place, points, img_shape, ne, sw, snap=snap, route=route, placements=placements, limit=limit,
+                )
+                response_cache.set(cache_key, response)
+            line.update(response)
+        except ValueError as e:
+            line["error"] = str(e)
+        except HTTPException as e:
+            line["error"] = e.detail
+        except Exception:
+            # e.g. a worker that died, the other lines still get through
+            traceback.print_exc()
+            line["error"] = "internal error"
+        finally:
+            # stream() waits for one line per task, even a cancelled one
+            await results.put(line)
+
+    tasks = [
+        asyncio.create_task(place_one(i, j, image_bytes))
+        for i, image_bytes in enumerate(image_contents)
+        for j in range(len(image_bounds[i]))
+    ]
+
+    async def stream():
+        try:
+            for _ in range(len(tasks)):
+                yield json.dumps(await results.get()) + "\n"
+        finally:
+            # stops the remaining work when the client goes away
+            for task in [*tasks, *image_jobs.values()]:
+                task.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@router.post("/jobs")
+async def start_job(
+    bounds: Annotated[str, Form(...)],
+    max_points: Annotated[str, Form(...)] = '50',
+    image: UploadFile = File(optional=True),
+    snap: Annotated[str, Form(...)] = 'false',
+    route: Annotated[str, Form(...)] = 'false',
+    placements: Annotated[str, Form(...)] = '1',
+):
+    '''
+    Starts the /coordinatize pipeline in the background and returns its id right away.
+    GET /jobs/{id}/events follows its progress, DELETE /jobs/{id} cancels it. A job nobody
+    follows for JOB_IDLE_TIMEOUT seconds is cancelled too
+    '''
+    ne, sw = parse_bounds(json.loads(bounds))
+    image_bytes = await read_image(image)
+    max_points = int(max_points)
+    snap = snap == "true"
+    route = route == "true"
+    placements = parse_placements(placements)
+
+    cache_key = response_key(image_bytes, ne, sw, max_points, snap, route, "json", False, placements)
+
+    async def run_job(job: Job):
+        nonlocal image_bytes
+        start = time.perf_counter()
+        try:
+            response = response_cache.get(cache_key)
+            if response is None:
+                points, img_shape = await run(pixel_points, image_bytes, max_points)
+                # the upload isn't needed past this point, finished jobs are kept for JOB_TTL
+                image_bytes = None
+                job.emit("pixels", {"points": points, "shape": list(img_shape)})
+                response = await run(
+                    place, points, img_shape, ne, sw, snap=snap, route=route, placements=placements,
+                    on_event=job.emit,
+                )
+                response_cache.set(cache_key, response)
+            job.emit("result", response)
+            request_seconds.observe("job", time.perf_counter() - start)
+        except ValueError as e:
+            job.emit("error", {"detail": str(e)})
+        except HTTPException as e:
+            job.emit("error", {"detail": e.detail})
+        except Exception:
+            traceback.print_exc()
+            job.emit("error", {"detail": "internal error"})
+
+    job = jobs.start(run_job)
+    return {"id": job.id}
+
+@router.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, last_event_id: Annotated[str | None, Header()] = None):
+    '''
+    Server-Sent Events of a job's stages as they finish: "pixels" (pixel-space points and image shape),
+    "placed" (points scaled into the bounds), "snapped" (fitted placements, snap or route only),
+    "routed" (per placement, route only) and "result" (the /coordinatize json response), or "error"
+    or "cancelled", then "done". Reconnecting with Last-Event-ID resumes after that event
+    '''
+    job = jobs.get(job_id)
+    start = 0
+    if last_event_id is not None:
+        if not last_event_id.isdigit():
+            raise HTTPException(status_code=400, detail="Last-Event-ID must be an event id")
+        start = int(last_event_id) + 1
+
+    async def stream():
+        async for index, event, data in job.follow(start):
+            yield f"id: {index}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
 
-    if snap == "true":
-        gps_coords_ndarray = fit_to_map(np.array(gps_coords))
-        gps_coords = gps_coords_ndarray.tolist()
+    # proxies must not buffer the stream or the stages arrive all at once
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(stream(), media_type="text/event-stream", headers=headers)
 
-    gpx_file = make_gpx(gps_coords)
+@router.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    job = jobs.get(job_id)
+    job.cancel()
+    return {"id": job.id, "done": job.done}
 
-    return {"points": gps_coords, "gpxFile": b64encode(gpx_file)}
+@router.get("/cache")
+async def cache_stats():
+    return {"response": response_cache.stats()}
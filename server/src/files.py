@@ -0,0 +1,40 @@
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+
+
+def remove_path(path: str):
+    '''
+    Deletes a file or directory tree if it exists
+    '''
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+@contextmanager
+def atomic_path(path: str):
+    '''
+    Yields a temporary path next to path to write a file or directory at, renamed onto path
+    once the block finishes so readers never see partial output. A directory that another
+    process already finished at path is kept and the new one dropped
+    '''
+    # the directory may have been pruned in the meantime
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    try:
+        yield tmp_path
+    except BaseException:
+        remove_path(tmp_path)
+        raise
+
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        if not os.path.isdir(tmp_path):
+            remove_path(tmp_path)
+            raise
+        # another process finished first
+        remove_path(tmp_path)
@@ -0,0 +1,234 @@
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+from src.spatial import DistanceField, NodeIndex, SegmentIndex
+
+
+@dataclass
+class RoadMatch:
+    '''
+    Fitted points matched onto the street graph. Point i lies offset[i] meters along
+    CSR edge edge[i] from node u[i] to node v[i] (graph node indices). When snapped to
+    a node u == v and edge is -1. iterations is how many ICP steps refined the placement
+    '''
+    latlon: np.ndarray
+    u: np.ndarray
+    v: np.ndarray
+    offset: np.ndarray
+    edge: np.ndarray
+    error: float
+    iterations: int = 0
+
+
+@dataclass
+class Placement:
+    '''
+    Similarity transform of the centered shape: rotation in degrees, uniform scale
+    and (x, y) translation from the center it was searched around, in projected meters
+    '''
+    rotation: float
+    scale: float
+    translation: np.ndarray
+    error: float = np.inf
+
+
+def rotation_matrices(rotation_degrees: np.ndarray) -> np.ndarray:
+    '''
+    (S,) counterclockwise rotations in degrees as (S, 2, 2) matrices
+    '''
+    rot_radians = np.radians(rotation_degrees)
+    cos, sin = np.cos(rot_radians), np.sin(rot_radians)
+    return np.stack([
+        np.stack([cos, -sin], axis=-1),
+        np.stack([sin, cos], axis=-1),
+    ], axis=1)
+
+
+def transform_arrays(
+    rotation_degrees: np.ndarray,
+    scales: np.ndarray,
+    translations: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    (S,) rotations in degrees, (S,) uniform scales and (S, 2) translations as the
+    (S, 2, 2), (S, 2) and (S, 2) arrays apply_transforms takes
+    '''
+    return rotation_matrices(rotation_degrees), np.repeat(scales[:, None], 2, axis=1), translations
+
+
+def apply_transforms(
+    centered_points: np.ndarray,
+    rotations: np.ndarray,
+    scales: np.ndarray,
+    translations: np.ndarray,
+) -> np.ndarray:
+    '''
+    Applies every seed's transform to the (N, 2) centered points, returning (S, N, 2)
+    '''
+    scaled = centered_points[None, :, :] * scales[:, None, :]
+    return np.einsum("snj,sij->sni", scaled, rotations) + translations[:, None, :]
+
+
+def fit_seeds(
+    index: NodeIndex | SegmentIndex | DistanceField,
+    centered_points: np.ndarray,
+    rotation_degrees: np.ndarray,
+    scales: np.ndarray,
+    translations: np.ndarray,
+    max_iterations: int = 10,
+    max_rotation_degrees: float = 45,
+    scale_range: tuple[float, float] = (0.9, 1.1),
+    translation_bounds: tuple[np.ndarray, np.ndarray] | None = None,
+    tolerance: float = 0.002,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    ICP from S starting transforms of the (N, 2) centered points: (S,) rotations in degrees,
+    (S, 2) xy scales and (S, 2) translations. Every iteration matches the points to their nearest
+    index points and solves for rotation, anisotropic scale and translation in closed form, clipped
+    to max_rotation_degrees, scale_range and translation_bounds (lower, upper). A seed stops once
+    its matches don't change or its error improves by less than tolerance (relative).
+    Returns (points (S, N, 2), mean snapping error (S,), iterations used (S,))
+    '''
+    scales = np.array(scales, dtype=np.float64)
+    points = apply_transforms(centered_points, rotation_matrices(np.asarray(rotation_degrees)), scales, np.asarray(translations))
+    distances, snapped = index.nearest_points(points)
+    errors = np.mean(distances, axis=1)
+    iterations = np.zeros(len(points), dtype=np.int64)
+    active = np.ones(len(points), dtype=bool)
+    spread = np.maximum(np.sum(centered_points ** 2, axis=0), 1e-9)
+
+    for _ in range(max_iterations):
+        seeds = np.flatnonzero(active)
+        if len(seeds) == 0:
+            break
+        mean_target = np.mean(snapped[seeds], axis=1)
+        centered_targets = snapped[seeds] - mean_target[:, None, :]
+
+        # rotation taking the scaled shape closest to the targets, then the scale per axis for it
+        model = centered_points[None, :, :] * scales[seeds][:, None, :]
+        dot = np.sum(model * centered_targets, axis=(1, 2))
+        cross = np.sum(model[..., 0] * centered_targets[..., 1] - model[..., 1] * centered_targets[..., 0], axis=1)
+        new_rotations = np.clip(np.degrees(np.arctan2(cross, dot)), -max_rotation_degrees, max_rotation_degrees)
+        matrices = rotation_matrices(new_rotations)
+        unrotated = np.einsum("sni,sij->snj", centered_targets, matrices)
+        new_scales = np.clip(np.sum(unrotated * centered_points, axis=1) / spread, *scale_range)
+        new_translations = mean_target
+        if translation_bounds is not None:
+            new_translations = np.clip(new_translations, *translation_bounds)
+
+        new_points = apply_transforms(centered_points, matrices, new_scales, new_translations)
+        new_distances, new_snapped = index.nearest_points(new_points)
+        new_errors = np.mean(new_distances, axis=1)
+        iterations[seeds] += 1
+
+        # the clipped solution can be worse, those seeds keep their last transform
+        better = new_errors < errors[seeds]
+        unchanged = np.all(new_snapped == snapped[seeds], axis=(1, 2))
+        converged = ~better | unchanged | (errors[seeds] - new_errors < tolerance * errors[seeds])
+        accepted = seeds[better]
+        scales[accepted] = new_scales[better]
+        points[accepted] = new_points[better]
+        snapped[accepted] = new_snapped[better]
+        errors[accepted] = new_errors[better]
+        active[seeds[converged]] = False
+
+    return points, errors, iterations
+
+
+def grid(center: float, step: float, radius: int) -> np.ndarray:
+    return center + step * np.arange(-radius, radius + 1)
+
+
+def search_placements(
+    index: NodeIndex | SegmentIndex | DistanceField,
+    centered_points: np.ndarray,
+    center: np.ndarray,
+    shape_size: np.ndarray,
+    max_rotation_degrees: float = 45,
+    scale_range: tuple[float, float] = (0.9, 1.1),
+    max_translation: float = 0.5,
+    levels: int = 4,
+    beam: int = 4,
+    coarse_points: int = 32,
+    min_separation: float | None = None,
+    time_budget: float | None = None,
+) -> list[Placement]:
+    '''
+    Deterministic coarse to fine search over rotation, scale and translation. The coarse level
+    scores a full grid (15 degree, 0.1 scale and quarter shape size steps, translations up to
+    max_translation shape sizes from center, so the shape stays in the bounds it was drawn in)
+    on coarse_points evenly spaced points. Every finer level halves the steps, scores the
+    neighbors of the beam best placements with twice as many points, and keeps the beam best again.
+    Kept placements have to be min_separation meters apart on average (a tenth of the shape's size
+    by default) so the beam doesn't collapse onto one spot.
+    Scoring is one batched index.distances call for all candidates, which only approximates the
+    road distance for a SegmentIndex or DistanceField. Refinement stops early once time_budget seconds have passed.
+    Returns the kept placements, lowest approximate error first
+    '''
+    start = time.perf_counter()
+    if min_separation is None:
+        min_separation = 0.1 * float(np.linalg.norm(shape_size))
+    rotation_step = 15.0
+    scale_step = 0.1
+    translation_step = np.maximum(shape_size, 1.0) / 4
+    max_shift = max_translation * np.maximum(shape_size, 1.0)
+
+    # full grid on the coarse level
+    rotations = grid(0, rotation_step, int(max_rotation_degrees // rotation_step))
+    scales = np.arange(scale_range[0], scale_range[1] + 1e-9, scale_step)
+    steps = int(round(max_translation * 4))
+    tx, ty = grid(0, translation_step[0], steps), grid(0, translation_step[1], steps)
+    r, s, x, y = (a.ravel() for a in np.meshgrid(rotations, scales, tx, ty, indexing="ij"))
+
+    placements = []
+    for level in range(levels):
+        num_points = min(len(centered_points), coarse_points * 2 ** level)
+        sample = centered_points[np.linspace(0, len(centered_points) - 1, num_points).round().astype(int)]
+        points = apply_transforms(sample, *transform_arrays(r, s, np.stack([x, y], axis=1) + center))
+        errors = np.mean(index.distances(points), axis=1)
+
+        best = distinct_placements(points, errors, beam, min_separation)
+        placements = [
+            Placement(float(r[i]), float(s[i]), np.array([x[i], y[i]]), float(errors[i]))
+            for i in best
+        ]
+        if level == levels - 1 or (time_budget is not None and time.perf_counter() - start > time_budget):
+            break
+
+        # neighbors of the kept placements at half the step
+        rotation_step, scale_step, translation_step = rotation_step / 2, scale_step / 2, translation_step / 2
+        neighbors = [
+            np.meshgrid(
+                np.clip(grid(p.rotation, rotation_step, 1), -max_rotation_degrees, max_rotation_degrees),
+                np.clip(grid(p.scale, scale_step, 1), *scale_range),
+                np.clip(grid(p.translation[0], translation_step[0], 1), -max_shift[0], max_shift[0]),
+                np.clip(grid(p.translation[1], translation_step[1], 1), -max_shift[1], max_shift[1]),
+                indexing="ij",
+            )
+            for p in placements
+        ]
+        r, s, x, y = (np.concatenate([n[k].ravel() for n in neighbors]) for k in range(4))
+
+    return placements
+
+
+def distinct_placements(
+    transformed_points: np.ndarray,
+    errors: np.ndarray,
+    top_k: int,
+    min_separation: float,
+) -> list[int]:
+    '''
+    Indices of up to top_k of the (S, N, 2) placements, lowest error first, skipping
+    any whose points are on average within min_separation meters of one already picked
+    '''
+    picked = []
+    available = np.isfinite(errors)
+    while len(picked) < top_k and available.any():
+        i = int(np.flatnonzero(available)[np.argmin(errors[available])])
+        picked.append(i)
+        separations = np.mean(np.linalg.norm(transformed_points - transformed_points[i], axis=-1), axis=-1)
+        available &= separations >= min_separation
+    return picked
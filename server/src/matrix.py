@@ -2,10 +2,17 @@ import os
 from functools import cache
 
 import numpy as np
-import osmnx as ox
-from pyproj import Proj
-
-import utm
+from pyproj import Transformer
+
+from src.fitting import (
+    RoadMatch,
+    distinct_placements,
+    fit_seeds,
+    search_placements,
+)
+from src.routing import ROUTE_CACHE_BYTES
+from src.snapshot import StreetGraph, convert_graphml, load_snapshot
+from src.tiles import TileStore, build_tiles
 
 # Miles per 1 degree.
 
@@ -13,121 +20,164 @@ LA_MAP_PATH = os.getenv("LA_MAP_PATH")
 if LA_MAP_PATH is None:
     raise Exception("env LA_MAP_PATH required")
 
+# flat array version of LA_MAP_PATH, converted on first use if missing
+LA_SNAPSHOT_PATH = os.getenv("LA_SNAPSHOT_PATH", f"{os.path.splitext(LA_MAP_PATH)[0]}.snapshot")
+
 @cache
-def get_map():
-    return ox.load_graphml(LA_MAP_PATH)
+def get_map() -> StreetGraph:
+    if not os.path.isdir(LA_SNAPSHOT_PATH):
+        convert_graphml(LA_MAP_PATH, LA_SNAPSHOT_PATH)
+    return load_snapshot(LA_SNAPSHOT_PATH)
+
+# the graph split into square tiles so requests only load the area around their bounds
+LA_TILES_PATH = os.getenv("LA_TILES_PATH", os.path.join(LA_SNAPSHOT_PATH, "tiles"))
+TILE_SIZE_DEGREES = float(os.getenv("TILE_SIZE_DEGREES", 0.02))
+# memory for loaded tiles and regions with their indexes and routers, including the ROUTE_CACHE_BYTES path cache
+TILE_CACHE_BYTES = int(os.getenv("TILE_CACHE_BYTES", 512 * 1024 * 1024))
+# disk space for the indexes and distance fields of multi-tile regions
+REGION_CACHE_DISK_BYTES = int(os.getenv("REGION_CACHE_DISK_BYTES", 2 * 1024 * 1024 * 1024))
+# tiles are loaded this many bounds widths/heights beyond the bounds, fitting may move the shape that far
+REGION_MARGIN = float(os.getenv("REGION_MARGIN", 1.0))
 
-mercator_projection = Proj(proj="merc", ellps="WGS84")
-def to_mercator(lat: float, lon: float) -> tuple[float, float]:
-    return mercator_projection(lon, lat)
+@cache
+def get_tiles() -> TileStore:
+    if not os.path.isdir(LA_TILES_PATH):
+        build_tiles(get_map(), LA_TILES_PATH, TILE_SIZE_DEGREES)
+    return TileStore(LA_TILES_PATH, max(TILE_CACHE_BYTES - ROUTE_CACHE_BYTES, 0), REGION_CACHE_DISK_BYTES)
 
-def from_mercator(x: float, y: float) -> tuple[float, float]:
-    return mercator_projection(x, y, inverse=True)
+def get_region(ne: list[float, float], sw: list[float, float]) -> StreetGraph:
+    '''
+    Street graph around the north east and south west lat, lon corners of a map view
+    '''
+    return get_tiles().region(ne[0], sw[0], ne[1], sw[1], REGION_MARGIN)
+
+@cache
+def mercator_transformers() -> tuple[Transformer, Transformer]:
+    '''
+    (lon, lat -> x, y) web-map style mercator projection and its inverse, created once
+    '''
+    return (
+        Transformer.from_crs("EPSG:4326", "+proj=merc +ellps=WGS84", always_xy=True),
+        Transformer.from_crs("+proj=merc +ellps=WGS84", "EPSG:4326", always_xy=True),
+    )
 
 def scale_and_place(
-    coordinates: list[list[int]],
+    coordinates: list[list[int]] | np.ndarray,
     ne: list[float, float],
     sw: list[float, float],
     y_max_pixels,
     x_max_pixels,
-):
-    north = ne[0]
-    south = sw[0]
-    east = ne[1]
-    west = sw[1]
-
-    # convert to mercator
-    north, east = to_mercator(north, east)
-    south, west = to_mercator(south, west)
-    
-    coords_normalized = [
-        (coord[0] / x_max_pixels, 1-coord[1] / y_max_pixels) 
-        for coord in coordinates
-    ]
-
-    coords_scaled = [
-        (
-            south + (north - south) * coord[0], 
-            west + (east - west) * coord[1]
-        )
-        for coord in coords_normalized
-    ]
-
-    return [
-        tuple(reversed(from_mercator(coord[0], coord[1])))
-        for coord in coords_scaled
-    ]
-
-
-def fit_to_map(pts: list[tuple[float, float]]):
+) -> np.ndarray:
+    '''
+    Stretches x, y pixel coordinates over the north east and south west lat, lon corners in
+    mercator space, so the drawing looks the same on the map. Returns (N, 2) lat, lon points
+    '''
+    to_mercator, from_mercator = mercator_transformers()
+    (west, east), (south, north) = to_mercator.transform([sw[1], ne[1]], [sw[0], ne[0]])
+
+    pixels = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+    x = west + (east - west) * (pixels[:, 0] / x_max_pixels)
+    y = south + (north - south) * (1 - pixels[:, 1] / y_max_pixels)
+
+    lon, lat = from_mercator.transform(x, y)
+    return np.stack([lat, lon], axis=1)
+
+
+# seconds the placement search may spend on refinement levels
+FIT_TIME_BUDGET = float(os.getenv("FIT_TIME_BUDGET", 0.25))
+
+def match_points(
+    street_graph: StreetGraph,
+    points: np.ndarray,
+    snap_to: str = "road",
+    iterations: int = 0,
+) -> RoadMatch:
+    '''
+    Snaps (N, 2) projected points exactly onto the nearest road, or intersection for snap_to="node".
+    The match's error is the mean snapping distance, iterations how many refinement steps found the points
     '''
-    pts: list of lat, lon points 
+    node_index = street_graph.node_index
+    if snap_to == "road":
+        distances, snapped, edges, offsets = street_graph.segment_index.project(points)
+        u = street_graph.edge_sources[edges]
+        v = street_graph.indices[edges].astype(np.int64)
+    else:
+        distances, u = node_index.query(points[:, 0], points[:, 1])
+        snapped = node_index.tree.data[u]
+        v = u
+        edges = np.full(len(u), -1)
+        offsets = np.zeros(len(u))
+
+    gps_coords = np.stack(node_index.to_latlon(snapped[:, 0], snapped[:, 1]), axis=1)
+    return RoadMatch(gps_coords, u, v, offsets, edges, float(np.mean(distances)), iterations)
+
+def fit_placements(
+    pts: list[tuple[float, float]] | np.ndarray,
+    top_k: int = 1,
+    num_iterations: int = 10,
+    snap_to: str = "road",
+    street_graph: StreetGraph | None = None,
+    time_budget: float | None = FIT_TIME_BUDGET,
+) -> list[RoadMatch]:
     '''
-    street_graph = get_map()
-
-    utm_pts_metadata = [
-        utm.from_latlon(pt[0], pt[1])[2:]
-        for pt in pts
-    ]
-
-    utm_pts_np = np.array(
-        [
-            utm.from_latlon(pt[0], pt[1])[:2]
-            for pt in pts
-        ]
+    pts: lat, lon points
+    top_k: number of distinct placements to return, best first
+    num_iterations: most ICP iterations refining each placement the search found
+    snap_to: "road" snaps to the closest point on any road, "node" only to intersections
+    street_graph: graph to fit to, usually from get_region. Defaults to the whole map
+    time_budget: seconds the coarse to fine search may spend refining
+    '''
+    if street_graph is None:
+        street_graph = get_map()
+    # indexes are in the graph's UTM zone, points are projected into the same zone.
+    # Placements are scored against the road distance raster and only the picked ones snapped exactly
+    node_index = street_graph.node_index
+    index = street_graph.distance_field if snap_to == "road" else node_index
+
+    pts = np.asarray(pts)
+    utm_pts_np = np.stack(node_index.to_projected(pts[:, 0], pts[:, 1]), axis=1)
+    pts_mean = np.mean(utm_pts_np, axis=0)
+    centered_points = utm_pts_np - pts_mean
+    shape_size = np.max(centered_points, axis=0) - np.min(centered_points, axis=0)
+
+    placements = search_placements(
+        index, centered_points, pts_mean, shape_size, beam=min(max(4, top_k), 16), time_budget=time_budget,
+    )
+    # refined without leaving the search's bounds, the shape stays within half its size of the bounds' center
+    fitted_points, errors, iterations = fit_seeds(
+        index,
+        centered_points,
+        np.array([p.rotation for p in placements]),
+        np.repeat(np.array([[p.scale] for p in placements]), 2, axis=1),
+        np.stack([p.translation for p in placements]) + pts_mean,
+        num_iterations,
+        translation_bounds=(pts_mean - 0.5 * shape_size, pts_mean + 0.5 * shape_size),
     )
 
-    num_seeds = 10
-
-    best_pts = None
-    lowest_err = np.inf
-
-    for _seed_no in range(num_seeds):
-        # apply random translation, rotation, and scaling
-        pts_mean = np.mean(utm_pts_np, axis=0)
-        centered_points = utm_pts_np - pts_mean
-        rot_degrees = np.random.uniform(-45, 45)
-        rot_radians = np.radians(rot_degrees)
-        rot_matrix = np.array([
-            [np.cos(rot_radians), -np.sin(rot_radians)],
-            [np.sin(rot_radians), np.cos(rot_radians)]
-        ])
-        shape_size = np.max(centered_points, axis=0) - np.min(centered_points, axis=0)
-        scale = np.random.uniform(0.9, 1.1, size=2)
-        translation = np.random.uniform(-1, 1, size=2) * shape_size
-
-        transformed_points = centered_points * scale @ rot_matrix.T + translation + pts_mean
-
-        for _ in range(10):
-            # find closes graph nodes to all points
-            node_ids = ox.distance.nearest_nodes(street_graph, transformed_points[:, 0], transformed_points[:, 1])
-            err_vectors = np.array([
-                [
-                    street_graph.nodes[node_id]["x"] - transformed_points[i, 0],
-                    street_graph.nodes[node_id]["y"] - transformed_points[i, 1]
-                ]
-                for i, node_id in enumerate(node_ids)
-            ])
-
-            avg_err = np.mean(err_vectors, axis=0)
-            
-            transformed_points = transformed_points + avg_err
-        
-        nearest_nodes = ox.distance.nearest_nodes(street_graph, transformed_points[:, 0], transformed_points[:, 1])
-        final_err = np.mean(np.linalg.norm(err_vectors, axis=1))
-        if final_err < lowest_err:
-            best_pts = nearest_nodes
-            lowest_err = final_err
-
-    # snap to nearest road
-    snapped_utm_points = np.array([
-        [street_graph.nodes[node_id]["x"], street_graph.nodes[node_id]["y"]]
-        for node_id in best_pts
-    ])
-
-    gps_coords = np.array([
-        utm.to_latlon(pt[0], pt[1], metadata[0], metadata[1])
-        for pt, metadata in zip(snapped_utm_points, utm_pts_metadata)
-    ])
-
-    return gps_coords
+    # alternatives have to move the shape by at least a tenth of its size
+    picked = distinct_placements(fitted_points, errors, top_k, 0.1 * float(np.linalg.norm(shape_size)))
+    matches = [match_points(street_graph, fitted_points[i], snap_to, int(iterations[i])) for i in picked]
+    return sorted(matches, key=lambda match: match.error)
+
+
+def fit_to_map(
+    pts: list[tuple[float, float]] | np.ndarray,
+    num_iterations: int = 10,
+    snap_to: str = "road",
+    street_graph: StreetGraph | None = None,
+    time_budget: float | None = FIT_TIME_BUDGET,
+) -> RoadMatch:
+    '''
+    Best placement of fit_placements
+    '''
+    return fit_placements(pts, 1, num_iterations, snap_to, street_graph, time_budget)[0]
+
+
+def follow_streets(road_match: RoadMatch, street_graph: StreetGraph | None = None) -> np.ndarray:
+    '''
+    Replaces the straight lines between matched points with shortest street paths.
+    street_graph must be the graph road_match was fitted to. Returns the full list of lat, lon points
+    '''
+    if street_graph is None:
+        street_graph = get_map()
+    return street_graph.router.route(road_match)
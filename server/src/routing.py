@@ -0,0 +1,294 @@
+import heapq
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from src.fitting import RoadMatch
+from src.snapshot import StreetGraph
+
+# memory for paths kept per process, shared by every request and region. Taken out of TILE_CACHE_BYTES
+ROUTE_CACHE_BYTES = int(os.getenv("ROUTE_CACHE_BYTES", 64 * 1024 * 1024))
+
+
+def cut_polyline(xy: np.ndarray, start: float, end: float) -> np.ndarray:
+    '''
+    Returns the part of a polyline between two distances along it, reversed if end < start
+    '''
+    if end < start:
+        return cut_polyline(xy, end, start)[::-1]
+    cumulative = np.concatenate([[0], np.cumsum(np.linalg.norm(np.diff(xy, axis=0), axis=1))])
+    start = min(max(start, 0), cumulative[-1])
+    end = min(max(end, 0), cumulative[-1])
+    inside = (cumulative > start) & (cumulative < end)
+    endpoints = [
+        [np.interp(d, cumulative, xy[:, 0]), np.interp(d, cumulative, xy[:, 1])]
+        for d in (start, end)
+    ]
+    return np.concatenate([endpoints[:1], xy[inside], endpoints[1:]])
+
+
+class PathCache:
+    '''
+    LRU of shortest paths by unordered pair of OSM node ids, each stored as the OSM ids of the
+    nodes along it from the smaller id to the larger one. Ids mean the same in every tile and
+    merged region, so overlapping regions reuse each other's paths
+    '''
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._paths: OrderedDict[tuple[int, int], tuple[int, ...]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._paths)
+
+    @staticmethod
+    def entry_nbytes(path: tuple[int, ...]) -> int:
+        '''
+        Rough size of an entry: the dict slot and key, then a tuple slot and int object per node
+        '''
+        return 200 + (8 + 32) * len(path)
+
+    def get(self, key: tuple[int, int]) -> tuple[int, ...] | None:
+        path = self._paths.get(key)
+        if path is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._paths.move_to_end(key)
+        return path
+
+    def set(self, key: tuple[int, int], path: tuple[int, ...]):
+        if key in self._paths:
+            self.nbytes -= self.entry_nbytes(self._paths.pop(key))
+        self._paths[key] = path
+        self.nbytes += self.entry_nbytes(path)
+        while self._paths and self.nbytes > self.max_bytes:
+            _, dropped = self._paths.popitem(last=False)
+            self.nbytes -= self.entry_nbytes(dropped)
+
+
+path_cache = PathCache(ROUTE_CACHE_BYTES)
+
+
+class Router:
+    '''
+    Shortest street paths on the array-backed graph. Walking and biking routes may use
+    one-way streets in both directions, so edges are searched as undirected
+    '''
+
+    def __init__(self, street_graph: StreetGraph, paths: PathCache = path_cache):
+        self.street_graph = street_graph
+        self.node_index = street_graph.node_index
+        self.paths = paths
+
+        # symmetric CSR: every edge plus its reverse, remembering which way the geometry runs
+        csr_edges = np.arange(street_graph.num_edges)
+        sources = np.concatenate([street_graph.edge_sources, street_graph.indices])
+        targets = np.concatenate([street_graph.indices, street_graph.edge_sources])
+        order = np.argsort(sources, kind="stable")
+        indptr = np.zeros(len(street_graph) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(street_graph)), out=indptr[1:])
+
+        # python lists are much faster than numpy scalars inside the search loop
+        self._indptr = indptr.tolist()
+        self._sources = sources[order].tolist()
+        self._indices = targets[order].tolist()
+        self._weights = np.concatenate([street_graph.lengths, street_graph.lengths])[order].tolist()
+        self._edges = np.concatenate([csr_edges, csr_edges])[order].tolist()
+        self._reversed = np.concatenate([np.zeros_like(csr_edges), np.ones_like(csr_edges)])[order].tolist()
+
+        # OSM id -> node lookups for paths cached by other regions
+        self._id_order = np.argsort(street_graph.node_ids, kind="stable")
+        self._sorted_ids = street_graph.node_ids[self._id_order]
+
+        # every edge geometry projected once, edge e is _geom_xy[geom_ptr[e]:geom_ptr[e+1]]
+        self._geom_xy = np.stack(self.node_index.to_projected(street_graph.geom_y, street_graph.geom_x), axis=1)
+
+    @property
+    def nbytes(self) -> int:
+        '''
+        Rough size of the adjacency lists, a list slot and an int or float object per entry,
+        plus the id lookup and projected geometries
+        '''
+        entries = len(self._indptr) + 5 * len(self._indices)
+        return entries * (8 + 28) + self._id_order.nbytes + self._sorted_ids.nbytes + self._geom_xy.nbytes
+
+    def shortest_path(self, source: int, target: int) -> tuple[float, tuple[tuple[int, bool], ...]]:
+        '''
+        Returns (length, ((csr edge, traversed backwards), ...)) from source to target node,
+        the length is inf if target is unreachable. A path cached by another region is reused
+        when all its nodes are in this graph, it is still shortest here unless this graph
+        is larger and has a shortcut the other one lacked
+        '''
+        node_ids = self.street_graph.node_ids
+        if node_ids[source] > node_ids[target]:
+            length, steps = self.shortest_path(target, source)
+            return length, tuple((edge, not backwards) for edge, backwards in reversed(steps))
+
+        key = (int(node_ids[source]), int(node_ids[target]))
+        path = self.paths.get(key)
+        found = self._path_steps(path) if path is not None else None
+        if found is not None:
+            return found
+
+        length, steps = self._shortest_path(source, target)
+        # unreachable pairs aren't shared, a larger region may connect them
+        if length < np.inf:
+            self.paths.set(key, self._path_ids(source, steps))
+        return length, steps
+
+    def _path_ids(self, source: int, steps: tuple[tuple[int, bool], ...]) -> tuple[int, ...]:
+        '''
+        OSM ids of the nodes a path from source visits
+        '''
+        nodes = [source]
+        for edge, backwards in steps:
+            nodes.append(int(self.street_graph.edge_sources[edge] if backwards else self.street_graph.indices[edge]))
+        return tuple(self.street_graph.node_ids[nodes].tolist())
+
+    def _path_steps(self, path: tuple[int, ...]) -> tuple[float, tuple[tuple[int, bool], ...]] | None:
+        '''
+        Turns a cached path back into (length, steps) on this graph, taking the shortest
+        edge between consecutive nodes. None if the path leaves this graph
+        '''
+        ids = np.asarray(path, dtype=self._sorted_ids.dtype)
+        found = np.minimum(np.searchsorted(self._sorted_ids, ids), len(self._sorted_ids) - 1)
+        if not np.array_equal(self._sorted_ids[found], ids):
+            return None
+        nodes = self._id_order[found].tolist()
+
+        length, steps = 0.0, []
+        for node, next_node in zip(nodes, nodes[1:]):
+            slots = [
+                slot for slot in range(self._indptr[node], self._indptr[node + 1])
+                if self._indices[slot] == next_node
+            ]
+            if not slots:
+                return None
+            slot = min(slots, key=self._weights.__getitem__)
+            length += self._weights[slot]
+            steps.append((self._edges[slot], bool(self._reversed[slot])))
+        return length, tuple(steps)
+
+    def _shortest_path(self, source: int, target: int) -> tuple[float, tuple[tuple[int, bool], ...]]:
+        '''
+        Bidirectional Dijkstra, alternating between whichever frontier is closer
+        '''
+        if source == target:
+            return 0.0, ()
+        indptr, indices, weights = self._indptr, self._indices, self._weights
+
+        dist = ({source: 0.0}, {target: 0.0})
+        # node -> symmetric edge slot used to reach it
+        prev = ({source: -1}, {target: -1})
+        heaps = ([(0.0, source)], [(0.0, target)])
+        settled = (set(), set())
+        best, meet = np.inf, -1
+
+        while heaps[0] and heaps[1]:
+            if heaps[0][0][0] + heaps[1][0][0] >= best:
+                break
+            side = 0 if heaps[0][0][0] <= heaps[1][0][0] else 1
+            d, node = heapq.heappop(heaps[side])
+            if node in settled[side]:
+                continue
+            settled[side].add(node)
+            side_dist, other_dist = dist[side], dist[1 - side]
+            for slot in range(indptr[node], indptr[node + 1]):
+                neighbor = indices[slot]
+                new_dist = d + weights[slot]
+                if new_dist < side_dist.get(neighbor, np.inf):
+                    side_dist[neighbor] = new_dist
+                    prev[side][neighbor] = slot
+                    heapq.heappush(heaps[side], (new_dist, neighbor))
+                    if neighbor in other_dist and new_dist + other_dist[neighbor] < best:
+                        best = new_dist + other_dist[neighbor]
+                        meet = neighbor
+
+        if meet == -1:
+            return np.inf, ()
+
+        # walk back from the meeting node to both ends
+        forward = []
+        node = meet
+        while prev[0][node] != -1:
+            slot = prev[0][node]
+            forward.append((self._edges[slot], bool(self._reversed[slot])))
+            node = self._sources[slot]
+        backward = []
+        node = meet
+        while prev[1][node] != -1:
+            slot = prev[1][node]
+            # the backward search walked this slot towards meet, the route goes the other way
+            backward.append((self._edges[slot], not self._reversed[slot]))
+            node = self._sources[slot]
+
+        return best, tuple(reversed(forward)) + tuple(backward)
+
+    def edge_xy(self, edge: int) -> np.ndarray:
+        '''
+        Projected polyline of a CSR edge, from its source to its target
+        '''
+        return self._geom_xy[self.street_graph.geom_ptr[edge]:self.street_graph.geom_ptr[edge + 1]]
+
+    def _edge_length(self, edge: int) -> float:
+        return float(np.sum(np.linalg.norm(np.diff(self.edge_xy(edge), axis=0), axis=1)))
+
+    def _leg(self, match: RoadMatch, match_xy: np.ndarray, i: int, j: int) -> np.ndarray:
+        '''
+        Projected polyline following the streets from matched point i to matched point j
+        '''
+        edge_i, edge_j = int(match.edge[i]), int(match.edge[j])
+        if edge_i != -1 and edge_i == edge_j:
+            return cut_polyline(self.edge_xy(edge_i), match.offset[i], match.offset[j])
+
+        # ways off edge i and onto edge j: (node, cost along the edge, polyline piece)
+        def ends(k: int, edge: int, leaving: bool):
+            if edge == -1:
+                node = int(match.u[k])
+                return [(node, 0.0, self.node_index.tree.data[node][None, :])]
+            xy, length, offset = self.edge_xy(edge), self._edge_length(edge), float(match.offset[k])
+            options = [(int(match.u[k]), offset, 0.0), (int(match.v[k]), length - offset, length)]
+            return [
+                (node, cost, cut_polyline(xy, offset, end) if leaving else cut_polyline(xy, end, offset))
+                for node, cost, end in options
+            ]
+
+        best_length, best = np.inf, None
+        for exit_node, exit_cost, exit_xy in ends(i, edge_i, True):
+            for entry_node, entry_cost, entry_xy in ends(j, edge_j, False):
+                length, steps = self.shortest_path(exit_node, entry_node)
+                if exit_cost + length + entry_cost < best_length:
+                    best_length = exit_cost + length + entry_cost
+                    best = (exit_xy, steps, entry_xy)
+
+        if best is None:
+            # no street connection, fall back to a straight line
+            return match_xy[[i, j]]
+
+        exit_xy, steps, entry_xy = best
+        pieces = [exit_xy] + [
+            self.edge_xy(edge)[::-1] if backwards else self.edge_xy(edge)
+            for edge, backwards in steps
+        ] + [entry_xy]
+        return np.concatenate(pieces)
+
+    def route(self, match: RoadMatch) -> np.ndarray:
+        '''
+        Expands consecutive matched points into street paths, returning the full lat, lon polyline
+        '''
+        match_xy = np.stack(self.node_index.to_projected(match.latlon[:, 0], match.latlon[:, 1]), axis=1)
+        legs = [self._leg(match, match_xy, i, i + 1) for i in range(len(match.latlon) - 1)]
+        if not legs:
+            return match.latlon
+        xy = np.concatenate(legs)
+
+        # drop repeated points where pieces join
+        keep = np.concatenate([[True], np.any(np.abs(np.diff(xy, axis=0)) > 1e-6, axis=1)])
+        xy = xy[keep]
+        return np.stack(self.node_index.to_latlon(xy[:, 0], xy[:, 1]), axis=1)
+
@@ -0,0 +1,229 @@
+import json
+import os
+import sys
+from functools import cached_property
+
+import numpy as np
+
+from src.files import atomic_path
+from src.spatial import DistanceField, NodeIndex, SegmentIndex, load_or_build, resident_nbytes
+
+# Arrays making up a snapshot, one .npy file each so they can be memory-mapped.
+SNAPSHOT_ARRAYS = ("node_ids", "x", "y", "indptr", "indices", "lengths", "geom_ptr", "geom_x", "geom_y")
+SNAPSHOT_VERSION = 2
+# meters per cell of the road distance rasters used to score placements
+DISTANCE_FIELD_RESOLUTION = float(os.getenv("DISTANCE_FIELD_RESOLUTION", 5))
+# larger regions get a coarser raster, this bounds the distance transform a request may run to
+# about 0.4 s and 64 MB, enough for a 10 x 10 km region at 5 m
+DISTANCE_FIELD_MAX_CELLS = int(os.getenv("DISTANCE_FIELD_MAX_CELLS", 4_000_000))
+
+
+class StreetGraph:
+    '''
+    Array-backed street graph. Node i has OSM id node_ids[i] at lon/lat (x[i], y[i]).
+    Its outgoing edges go to indices[indptr[i]:indptr[i+1]] with the matching lengths (meters).
+    The lon/lat polyline of CSR edge e is geom_x/geom_y[geom_ptr[e]:geom_ptr[e+1]]
+    '''
+
+    def __init__(
+        self,
+        node_ids: np.ndarray,
+        x: np.ndarray,
+        y: np.ndarray,
+        indptr: np.ndarray,
+        indices: np.ndarray,
+        lengths: np.ndarray,
+        geom_ptr: np.ndarray,
+        geom_x: np.ndarray,
+        geom_y: np.ndarray,
+        path: str | None = None,
+    ):
+        self.node_ids = node_ids
+        self.x = x
+        self.y = y
+        self.indptr = indptr
+        self.indices = indices
+        self.lengths = lengths
+        self.geom_ptr = geom_ptr
+        self.geom_x = geom_x
+        self.geom_y = geom_y
+        self.path = path
+
+    def __len__(self) -> int:
+        return len(self.node_ids)
+
+    @property
+    def num_edges(self) -> int:
+        return len(self.indices)
+
+    @property
+    def nbytes(self) -> int:
+        '''
+        Memory held by the graph: its arrays that aren't memory-mapped plus whichever
+        indexes and router have been built for it so far
+        '''
+        nbytes = resident_nbytes(*(getattr(self, name) for name in SNAPSHOT_ARRAYS))
+        for name in ("edge_sources", "node_index", "segment_index", "distance_field", "router"):
+            # cached properties only show up in __dict__ once built
+            built = self.__dict__.get(name)
+            if built is not None:
+                nbytes += built.nbytes
+        return nbytes
+
+    def neighbors(self, i: int) -> np.ndarray:
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    @cached_property
+    def edge_sources(self) -> np.ndarray:
+        '''
+        Source node of every CSR edge
+        '''
+        return np.repeat(np.arange(len(self), dtype=np.int64), np.diff(self.indptr))
+
+    def _index_path(self, name: str) -> str | None:
+        return os.path.join(self.path, name) if self.path is not None else None
+
+    @cached_property
+    def node_index(self) -> NodeIndex:
+        '''
+        Projected KD-tree over the nodes, persisted inside the snapshot directory
+        '''
+        return load_or_build(self._index_path("node_index.pkl"), lambda: NodeIndex.build(self.x, self.y))
+
+    @cached_property
+    def segment_index(self) -> SegmentIndex:
+        '''
+        Projected index over the edge geometries, persisted inside the snapshot directory.
+        Two-way streets are indexed once, through their u <= v edge
+        '''
+        def build():
+            sources = self.edge_sources
+            targets = self.indices.astype(np.int64)
+            has_reverse = np.isin(targets * len(self) + sources, sources * len(self) + targets)
+            edge_ids = np.flatnonzero(~has_reverse | (sources <= targets))
+            return SegmentIndex.build(self.node_index, edge_ids, self.geom_ptr, self.geom_x, self.geom_y)
+
+        return load_or_build(self._index_path("segment_index.pkl"), build)
+
+    @cached_property
+    def distance_field(self) -> DistanceField:
+        '''
+        Road distance raster over the segment index, persisted inside the snapshot directory
+        and memory-mapped
+        '''
+        return DistanceField.load_or_build(
+            self._index_path("distance_field"),
+            lambda: DistanceField.build(self.segment_index, DISTANCE_FIELD_RESOLUTION, max_cells=DISTANCE_FIELD_MAX_CELLS),
+        )
+
+    @cached_property
+    def router(self):
+        '''
+        Shortest path engine for this graph, sharing the process-wide path cache
+        '''
+        # imported here since routing depends on this module
+        from src.routing import Router
+
+        return Router(self)
+
+    def nearest_nodes(self, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        '''
+        Returns the index of the closest node to every projected (UTM) point
+        '''
+        _, nearest = self.node_index.query(xs, ys)
+        return nearest
+
+
+def graph_to_arrays(G) -> dict[str, np.ndarray]:
+    '''
+    Flattens a networkx (Multi)DiGraph loaded by osmnx into snapshot arrays
+    '''
+    node_ids = np.fromiter(G.nodes, dtype=np.int64, count=len(G))
+    index_of = {node_id: i for i, node_id in enumerate(node_ids.tolist())}
+    x = np.array([G.nodes[n]["x"] for n in node_ids.tolist()], dtype=np.float64)
+    y = np.array([G.nodes[n]["y"] for n in node_ids.tolist()], dtype=np.float64)
+
+    edges = [
+        (index_of[u], index_of[v], float(data.get("length", 0.0)), data.get("geometry"))
+        for u, v, data in G.edges(data=True)
+    ]
+    sources = np.array([e[0] for e in edges], dtype=np.int64)
+    targets = np.array([e[1] for e in edges], dtype=np.int32)
+    lengths = np.array([e[2] for e in edges], dtype=np.float32)
+
+    # sort edges by source node to get CSR order
+    order = np.argsort(sources, kind="stable")
+    indptr = np.zeros(len(node_ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=len(node_ids)), out=indptr[1:])
+
+    # simplified edges carry a geometry, the rest are straight node to node lines
+    geometries = [
+        np.asarray(geometry.coords)[:, :2] if geometry is not None else np.array([[x[u], y[u]], [x[v], y[v]]])
+        for u, v, _, geometry in (edges[i] for i in order)
+    ]
+    geom_ptr = np.zeros(len(edges) + 1, dtype=np.int64)
+    np.cumsum([len(g) for g in geometries], out=geom_ptr[1:])
+    geom_xy = np.concatenate(geometries) if geometries else np.zeros((0, 2))
+
+    return {
+        "node_ids": node_ids,
+        "x": x,
+        "y": y,
+        "indptr": indptr,
+        "indices": targets[order],
+        "lengths": lengths[order],
+        "geom_ptr": geom_ptr,
+        "geom_x": geom_xy[:, 0].copy(),
+        "geom_y": geom_xy[:, 1].copy(),
+    }
+
+
+def save_snapshot(arrays: dict[str, np.ndarray], snapshot_path: str, meta: dict | None = None):
+    '''
+    Writes arrays as a snapshot directory. The directory is written next to its
+    final location and renamed into place so concurrent readers never see a partial snapshot
+    '''
+    with atomic_path(snapshot_path) as tmp_path:
+        os.makedirs(tmp_path)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, f"{name}.npy"), np.ascontiguousarray(array))
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump({"version": SNAPSHOT_VERSION, **(meta or {})}, f)
+
+
+def convert_graphml(graphml_path: str, snapshot_path: str):
+    '''
+    One-time conversion of an osmnx GraphML file into a snapshot directory
+    '''
+    # osmnx is slow to import and only needed here
+    import osmnx as ox
+
+    G = ox.load_graphml(graphml_path)
+    save_snapshot(graph_to_arrays(G), snapshot_path, {"source": os.path.basename(graphml_path)})
+
+
+def load_snapshot(snapshot_path: str) -> StreetGraph:
+    '''
+    Memory-maps a snapshot directory. Pages are loaded lazily and shared between processes
+    '''
+    with open(os.path.join(snapshot_path, "meta.json")) as f:
+        meta = json.load(f)
+    if meta.get("version") != SNAPSHOT_VERSION:
+        raise Exception(
+            f"snapshot {snapshot_path} has version {meta.get('version')}, expected {SNAPSHOT_VERSION}. "
+            "Delete it or rerun python -m src.snapshot"
+        )
+
+    arrays = {
+        name: np.load(os.path.join(snapshot_path, f"{name}.npy"), mmap_mode="r")
+        for name in SNAPSHOT_ARRAYS
+    }
+    return StreetGraph(**arrays, path=snapshot_path)
+
+
+if __name__ == "__main__":
+    # usage: python -m src.snapshot LA.graphml [LA.snapshot]
+    graphml_path = sys.argv[1]
+    snapshot_path = sys.argv[2] if len(sys.argv) > 2 else f"{os.path.splitext(graphml_path)[0]}.snapshot"
+    convert_graphml(graphml_path, snapshot_path)
+    print(f"wrote {snapshot_path}")
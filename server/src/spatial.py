@@ -0,0 +1,341 @@
+import json
+import os
+import pickle
+from functools import cache
+from typing import Callable, TypeVar
+
+import numpy as np
+from pyproj import Transformer
+from scipy.ndimage import distance_transform_edt
+from scipy.spatial import cKDTree
+
+from src.files import atomic_path
+
+T = TypeVar("T")
+
+# latitude bands of 8 degrees from 80S, N and later are in the northern hemisphere
+UTM_BANDS = "CDEFGHJKLMNPQRSTUVWX"
+
+
+@cache
+def utm_transformers(zone_number: int, zone_letter: str) -> tuple[Transformer, Transformer]:
+    '''
+    (lon, lat -> easting, northing) and its inverse for one UTM zone, created once per zone
+    '''
+    epsg = (32600 if zone_letter >= "N" else 32700) + zone_number
+    return (
+        Transformer.from_crs("EPSG:4326", f"EPSG:{epsg}", always_xy=True),
+        Transformer.from_crs(f"EPSG:{epsg}", "EPSG:4326", always_xy=True),
+    )
+
+
+def resident_nbytes(*arrays: np.ndarray) -> int:
+    '''
+    Bytes the arrays hold in memory, memory-mapped ones are paged in and out by the OS and don't count
+    '''
+    return sum(array.nbytes for array in arrays if not isinstance(array, np.memmap))
+
+
+def load_or_build(index_path: str | None, build: Callable[[], T]) -> T:
+    '''
+    Loads the index pickled at index_path, building it and saving it there if missing
+    '''
+    if index_path is not None and os.path.exists(index_path):
+        with open(index_path, "rb") as f:
+            return pickle.load(f)
+
+    index = build()
+    if index_path is not None:
+        with atomic_path(index_path) as tmp_path, open(tmp_path, "wb") as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return index
+
+
+class NodeIndex:
+    '''
+    KD-tree over street nodes projected into a single UTM zone, so nearest-node
+    queries are in meters and in the same coordinate system as the fitted points
+    '''
+
+    def __init__(self, tree: cKDTree, zone_number: int, zone_letter: str):
+        self.tree = tree
+        self.zone_number = zone_number
+        self.zone_letter = zone_letter
+
+    @property
+    def nbytes(self) -> int:
+        return resident_nbytes(self.tree.data, self.tree.indices)
+
+    @classmethod
+    def build(cls, lon: np.ndarray, lat: np.ndarray) -> "NodeIndex":
+        # one zone for the whole graph, picked at its median point
+        mid_lat = float(np.median(lat))
+        mid_lon = float(np.median(lon))
+        zone_number = int((mid_lon + 180) // 6) % 60 + 1
+        zone_letter = UTM_BANDS[min(max(int((mid_lat + 80) // 8), 0), len(UTM_BANDS) - 1)]
+
+        forward, _ = utm_transformers(zone_number, zone_letter)
+        easting, northing = forward.transform(np.asarray(lon), np.asarray(lat))
+        return cls(cKDTree(np.stack([easting, northing], axis=1)), zone_number, zone_letter)
+
+    @property
+    def x(self) -> np.ndarray:
+        return self.tree.data[:, 0]
+
+    @property
+    def y(self) -> np.ndarray:
+        return self.tree.data[:, 1]
+
+    def to_projected(self, lat: np.ndarray, lon: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        forward, _ = utm_transformers(self.zone_number, self.zone_letter)
+        return forward.transform(np.asarray(lon), np.asarray(lat))
+
+    def to_latlon(self, easting: np.ndarray, northing: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        _, inverse = utm_transformers(self.zone_number, self.zone_letter)
+        lon, lat = inverse.transform(np.asarray(easting), np.asarray(northing))
+        return lat, lon
+
+    def query(self, xs: np.ndarray, ys: np.ndarray, k: int = 1) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Returns (distances, node indices) of the k closest nodes to every projected point.
+        Works on arrays of any shape; k > 1 adds a trailing axis
+        '''
+        return self.tree.query(np.stack([xs, ys], axis=-1), k=k)
+
+    def nearest_points(self, points: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Returns (distances, snapped xy) of the closest node to every (..., 2) projected point
+        '''
+        distances, node_ids = self.tree.query(points)
+        return distances, self.tree.data[node_ids]
+
+    def distances(self, points: np.ndarray) -> np.ndarray:
+        return self.tree.query(points)[0]
+
+
+class SegmentIndex:
+    '''
+    Index over the straight pieces of every edge geometry, projected like NodeIndex.
+    Pieces are at most max_piece_length meters long and a KD-tree over their midpoints
+    finds candidates, so the nearest road point is found among the k closest midpoints
+    '''
+
+    def __init__(
+        self,
+        tree: cKDTree,
+        starts: np.ndarray,
+        ends: np.ndarray,
+        edges: np.ndarray,
+        offsets: np.ndarray,
+        k: int = 8,
+    ):
+        self.tree = tree
+        # piece i goes from starts[i] to ends[i] and lies offsets[i] meters into CSR edge edges[i]
+        self.starts = starts
+        self.ends = ends
+        self.edges = edges
+        self.offsets = offsets
+        self.k = k
+
+    @property
+    def nbytes(self) -> int:
+        return resident_nbytes(self.tree.data, self.tree.indices, self.starts, self.ends, self.edges, self.offsets)
+
+    @classmethod
+    def build(
+        cls,
+        node_index: NodeIndex,
+        edge_ids: np.ndarray,
+        geom_ptr: np.ndarray,
+        geom_x: np.ndarray,
+        geom_y: np.ndarray,
+        max_piece_length: float = 25,
+    ) -> "SegmentIndex":
+        '''
+        edge_ids: CSR edges to index, their geometry is geom_x/y[geom_ptr[e]:geom_ptr[e+1]] in lon/lat
+        '''
+        px, py = node_index.to_projected(geom_y, geom_x)
+        vertices = np.stack([px, py], axis=1)
+
+        # every consecutive vertex pair within an edge geometry is a segment
+        counts = geom_ptr[edge_ids + 1] - geom_ptr[edge_ids] - 1
+        first_seg = np.cumsum(counts) - counts
+        seg_edges = np.repeat(edge_ids, counts)
+        seg_vertices = np.repeat(geom_ptr[edge_ids] - first_seg, counts) + np.arange(counts.sum())
+        seg_a = vertices[seg_vertices]
+        seg_b = vertices[seg_vertices + 1]
+        seg_lengths = np.linalg.norm(seg_b - seg_a, axis=1)
+
+        # offset of every segment start along its edge
+        seg_start_offsets = np.cumsum(seg_lengths) - seg_lengths
+        seg_offsets = seg_start_offsets - np.repeat(seg_start_offsets[first_seg], counts)
+
+        # split long segments into pieces so midpoint candidates stay close to the true nearest point
+        pieces = np.maximum(np.ceil(seg_lengths / max_piece_length), 1).astype(np.int64)
+        seg_of_piece = np.repeat(np.arange(len(seg_a)), pieces)
+        piece_no = np.arange(pieces.sum()) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+        t0 = (piece_no / pieces[seg_of_piece])[:, None]
+        t1 = ((piece_no + 1) / pieces[seg_of_piece])[:, None]
+        direction = seg_b[seg_of_piece] - seg_a[seg_of_piece]
+        starts = seg_a[seg_of_piece] + t0 * direction
+        ends = seg_a[seg_of_piece] + t1 * direction
+        offsets = seg_offsets[seg_of_piece] + t0[:, 0] * seg_lengths[seg_of_piece]
+
+        tree = cKDTree((starts + ends) / 2)
+        return cls(tree, starts, ends, seg_edges[seg_of_piece], offsets)
+
+    def project(self, points: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        '''
+        Projects (..., 2) points onto their nearest piece.
+        Returns (distances, snapped xy, CSR edge ids, offsets along the edge in meters)
+        '''
+        k = min(self.k, len(self.starts))
+        _, candidates = self.tree.query(points, k=k)
+        if k == 1:
+            candidates = candidates[..., None]
+
+        a = self.starts[candidates]
+        ab = self.ends[candidates] - a
+        ap = points[..., None, :] - a
+        length_sq = np.maximum(np.sum(ab * ab, axis=-1), 1e-12)
+        t = np.clip(np.sum(ap * ab, axis=-1) / length_sq, 0, 1)
+        projected = a + t[..., None] * ab
+        distances = np.linalg.norm(points[..., None, :] - projected, axis=-1)
+
+        best = np.argmin(distances, axis=-1)[..., None]
+        best_piece = np.take_along_axis(candidates, best, axis=-1)[..., 0]
+        best_t = np.take_along_axis(t, best, axis=-1)[..., 0]
+        snapped = np.take_along_axis(projected, best[..., None], axis=-2)[..., 0, :]
+        best_length = np.sqrt(np.take_along_axis(length_sq, best, axis=-1)[..., 0])
+        offsets = self.offsets[best_piece] + best_t * best_length
+        return np.take_along_axis(distances, best, axis=-1)[..., 0], snapped, self.edges[best_piece], offsets
+
+    def nearest_points(self, points: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Returns (distances, snapped xy) of the closest road point to every (..., 2) projected point
+        '''
+        distances, snapped, _, _ = self.project(points)
+        return distances, snapped
+
+    def distances(self, points: np.ndarray) -> np.ndarray:
+        '''
+        Distance to the closest piece midpoint, within half a piece of the distance to the road
+        '''
+        return self.tree.query(points)[0]
+
+
+class DistanceField:
+    '''
+    Distance to the nearest road, and the cell of that road, for every resolution x resolution
+    meter cell of a raster over a SegmentIndex's pieces. Cell (i, j) is centered at
+    origin + ((j + 0.5), (i + 0.5)) * resolution in the index's projected coordinates
+    '''
+
+    def __init__(self, distance: np.ndarray, nearest: np.ndarray, origin: np.ndarray, resolution: float):
+        self.distance = distance
+        # (2, H, W) row and column of every cell's nearest road cell
+        self.nearest = nearest
+        self.origin = origin
+        self.resolution = resolution
+
+    @property
+    def nbytes(self) -> int:
+        return resident_nbytes(self.distance, self.nearest)
+
+    @classmethod
+    def build(
+        cls,
+        segment_index: SegmentIndex,
+        resolution: float = 5,
+        padding: float = 100,
+        max_cells: int = 4_000_000,
+    ) -> "DistanceField":
+        '''
+        Rasterizes the pieces with padding meters around them and runs an exact euclidean distance
+        transform. The resolution is coarsened if the raster would have more than max_cells cells
+        '''
+        points = np.concatenate([segment_index.starts, segment_index.ends])
+        origin = points.min(axis=0) - padding
+        extent = points.max(axis=0) + padding - origin
+        resolution = max(resolution, float(np.sqrt(extent[0] * extent[1] / max_cells)))
+        width, height = np.maximum(np.ceil(extent / resolution).astype(np.int64), 2)
+
+        # samples every half cell along each piece
+        lengths = np.linalg.norm(segment_index.ends - segment_index.starts, axis=1)
+        samples = np.ceil(lengths / (resolution / 2)).astype(np.int64) + 1
+        piece = np.repeat(np.arange(len(lengths)), samples)
+        t = (np.arange(samples.sum()) - np.repeat(np.cumsum(samples) - samples, samples)) / np.repeat(np.maximum(samples - 1, 1), samples)
+        xy = segment_index.starts[piece] + t[:, None] * (segment_index.ends[piece] - segment_index.starts[piece])
+        columns, rows = ((xy - origin) / resolution).astype(np.int64).T
+
+        off_road = np.ones((height, width), dtype=bool)
+        off_road[rows, columns] = False
+        distance, nearest = distance_transform_edt(off_road, sampling=resolution, return_indices=True)
+        return cls(distance.astype(np.float32), nearest.astype(np.int32), origin, resolution)
+
+    def save(self, path: str):
+        with atomic_path(path) as tmp_path:
+            os.makedirs(tmp_path)
+            np.save(os.path.join(tmp_path, "distance.npy"), self.distance)
+            np.save(os.path.join(tmp_path, "nearest.npy"), self.nearest)
+            with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+                json.dump({"origin": self.origin.tolist(), "resolution": self.resolution}, f)
+
+    @classmethod
+    def load(cls, path: str) -> "DistanceField":
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        return cls(
+            np.load(os.path.join(path, "distance.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "nearest.npy"), mmap_mode="r"),
+            np.array(meta["origin"]),
+            meta["resolution"],
+        )
+
+    @classmethod
+    def load_or_build(cls, path: str | None, build: Callable[[], "DistanceField"]) -> "DistanceField":
+        '''
+        Memory-maps the field saved at path, building and saving it there first if missing
+        '''
+        if path is None:
+            return build()
+        if not os.path.exists(os.path.join(path, "meta.json")):
+            build().save(path)
+        return cls.load(path)
+
+    def _cells(self, points: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''
+        Fractional (column, row) of points clamped to the raster, and how far outside it they are in meters
+        '''
+        height, width = self.distance.shape
+        fractional = (points - self.origin) / self.resolution - 0.5
+        clamped = np.clip(fractional, 0, [width - 1, height - 1])
+        outside = np.linalg.norm(fractional - clamped, axis=-1) * self.resolution
+        return clamped[..., 0], clamped[..., 1], outside
+
+    def distances(self, points: np.ndarray) -> np.ndarray:
+        '''
+        Bilinearly interpolated road distance of every (..., 2) projected point.
+        Points off the raster get the distance from its edge added
+        '''
+        height, width = self.distance.shape
+        fx, fy, outside = self._cells(points)
+        j = np.minimum(fx.astype(np.intp), width - 2)
+        i = np.minimum(fy.astype(np.intp), height - 2)
+        tx, ty = fx - j, fy - i
+        d = self.distance
+        return (
+            (d[i, j] * (1 - tx) + d[i, j + 1] * tx) * (1 - ty)
+            + (d[i + 1, j] * (1 - tx) + d[i + 1, j + 1] * tx) * ty
+            + outside
+        )
+
+    def nearest_points(self, points: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Returns (distances, snapped xy) of the nearest road cell center to every (..., 2) projected point,
+        within a cell of the true nearest road point
+        '''
+        fx, fy, _ = self._cells(points)
+        rows, columns = self.nearest[:, np.rint(fy).astype(np.intp), np.rint(fx).astype(np.intp)]
+        snapped = self.origin + (np.stack([columns, rows], axis=-1) + 0.5) * self.resolution
+        return np.linalg.norm(points - snapped, axis=-1), snapped
@@ -0,0 +1,224 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+from collections import OrderedDict
+
+import numpy as np
+
+from src.files import atomic_path
+from src.snapshot import StreetGraph, load_snapshot, save_snapshot
+
+TILES_VERSION = 1
+
+
+def gather_ranges(ptr: np.ndarray, ids: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    For ragged rows ptr[i]:ptr[i+1], returns (new ptr, flat positions) of the rows in ids, in order
+    '''
+    counts = ptr[ids + 1] - ptr[ids]
+    new_ptr = np.zeros(len(ids) + 1, dtype=np.int64)
+    np.cumsum(counts, out=new_ptr[1:])
+    positions = np.repeat(ptr[ids] - new_ptr[:-1], counts) + np.arange(new_ptr[-1])
+    return new_ptr, positions
+
+
+def tile_keys(x: np.ndarray, y: np.ndarray, tile_size: float) -> np.ndarray:
+    '''
+    (ix, iy) tile of every lon/lat point as an (N, 2) int array
+    '''
+    return np.stack([np.floor(x / tile_size), np.floor(y / tile_size)], axis=1).astype(np.int64)
+
+
+def build_tiles(street_graph: StreetGraph, tiles_path: str, tile_size: float):
+    '''
+    Splits the graph into tile_size degree tiles saved as snapshot directories under tiles_path.
+    A tile holds the edges leaving its nodes, plus the nodes at the far end of those edges
+    '''
+    node_tiles = tile_keys(np.asarray(street_graph.x), np.asarray(street_graph.y), tile_size)
+    keys, node_tile = np.unique(node_tiles, axis=0, return_inverse=True)
+    node_tile = node_tile.reshape(-1)
+    edge_tile = node_tile[street_graph.edge_sources]
+
+    node_order = np.argsort(node_tile, kind="stable")
+    node_splits = np.cumsum(np.bincount(node_tile, minlength=len(keys)))[:-1]
+    edge_order = np.argsort(edge_tile, kind="stable")
+    edge_splits = np.cumsum(np.bincount(edge_tile, minlength=len(keys)))[:-1]
+
+    with atomic_path(tiles_path) as tmp_path:
+        os.makedirs(tmp_path)
+        for (ix, iy), own_nodes, edges in zip(
+            keys.tolist(), np.split(node_order, node_splits), np.split(edge_order, edge_splits)
+        ):
+            # edges stay in CSR order since they were sorted by source node
+            edges = np.sort(edges)
+            targets = street_graph.indices[edges]
+            nodes = np.union1d(own_nodes, targets)
+            local_sources = np.searchsorted(nodes, street_graph.edge_sources[edges])
+            indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(local_sources, minlength=len(nodes)), out=indptr[1:])
+            geom_ptr, geom_positions = gather_ranges(street_graph.geom_ptr, edges)
+
+            save_snapshot({
+                "node_ids": street_graph.node_ids[nodes],
+                "x": street_graph.x[nodes],
+                "y": street_graph.y[nodes],
+                "indptr": indptr,
+                "indices": np.searchsorted(nodes, targets).astype(np.int32),
+                "lengths": street_graph.lengths[edges],
+                "geom_ptr": geom_ptr,
+                "geom_x": street_graph.geom_x[geom_positions],
+                "geom_y": street_graph.geom_y[geom_positions],
+            }, os.path.join(tmp_path, f"{ix}_{iy}"))
+
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump({"version": TILES_VERSION, "tile_size": tile_size, "tiles": keys.tolist()}, f)
+
+
+def directory_nbytes(path: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def merge_graphs(graphs: list[StreetGraph]) -> StreetGraph:
+    '''
+    Joins tiles into one graph, deduplicating the nodes shared along tile borders
+    '''
+    if len(graphs) == 1:
+        return graphs[0]
+
+    node_ids = np.concatenate([g.node_ids for g in graphs])
+    unique_ids, first, inverse = np.unique(node_ids, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    node_offsets = np.cumsum([0] + [len(g) for g in graphs])
+    geom_offsets = np.cumsum([0] + [len(g.geom_x) for g in graphs])
+    sources = np.concatenate([inverse[off + g.edge_sources] for off, g in zip(node_offsets, graphs)])
+    targets = np.concatenate([inverse[off + g.indices] for off, g in zip(node_offsets, graphs)])
+    lengths = np.concatenate([g.lengths for g in graphs])
+    geom_ptr = np.concatenate(
+        [off + g.geom_ptr[:-1] for off, g in zip(geom_offsets, graphs)] + [[geom_offsets[-1]]]
+    )
+
+    order = np.argsort(sources, kind="stable")
+    indptr = np.zeros(len(unique_ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=len(unique_ids)), out=indptr[1:])
+    new_geom_ptr, geom_positions = gather_ranges(geom_ptr, order)
+
+    return StreetGraph(
+        node_ids=unique_ids,
+        x=np.concatenate([g.x for g in graphs])[first],
+        y=np.concatenate([g.y for g in graphs])[first],
+        indptr=indptr,
+        indices=targets[order].astype(np.int32),
+        lengths=lengths[order],
+        geom_ptr=new_geom_ptr,
+        geom_x=np.concatenate([g.geom_x for g in graphs])[geom_positions],
+        geom_y=np.concatenate([g.geom_y for g in graphs])[geom_positions],
+    )
+
+
+class TileStore:
+    '''
+    Loads the tiles around a request's bounds on demand. Tiles and the regions merged
+    from them share one LRU that evicts the least recently used entries past memory_budget bytes.
+    Indexes are built lazily after a graph is handed out, so sizes are measured again on every lookup.
+    The indexes and distance fields of multi-tile regions are kept on disk under tiles_path/regions,
+    the least recently loaded ones are deleted past disk_budget bytes
+    '''
+
+    def __init__(self, tiles_path: str, memory_budget: int, disk_budget: int = 2 * 1024 ** 3):
+        with open(os.path.join(tiles_path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("version") != TILES_VERSION:
+            raise Exception(f"tiles {tiles_path} have version {meta.get('version')}, expected {TILES_VERSION}")
+
+        self.tiles_path = tiles_path
+        self.tile_size = meta["tile_size"]
+        # (T, 2) tile keys sorted by ix, then iy
+        keys = np.array(meta["tiles"], dtype=np.int64).reshape(-1, 2)
+        self.tile_keys = keys[np.lexsort((keys[:, 1], keys[:, 0]))]
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self._cache: OrderedDict[tuple, StreetGraph] = OrderedDict()
+
+    def cache_bytes(self) -> int:
+        # single tile regions are the tile itself, counted once
+        graphs = {id(street_graph): street_graph for street_graph in self._cache.values()}
+        return sum(street_graph.nbytes for street_graph in graphs.values())
+
+    def _get(self, key: tuple, load) -> StreetGraph:
+        if key in self._cache:
+            self._cache.move_to_end(key)
+        else:
+            self._cache[key] = load()
+        street_graph = self._cache[key]
+        while len(self._cache) > 1 and self.cache_bytes() > self.memory_budget:
+            self._cache.popitem(last=False)
+        return street_graph
+
+    def tile(self, ix: int, iy: int) -> StreetGraph:
+        return self._get(("tile", ix, iy), lambda: load_snapshot(os.path.join(self.tiles_path, f"{ix}_{iy}")))
+
+    def tiles_in_bounds(self, north: float, south: float, east: float, west: float) -> list[tuple[int, int]]:
+        (min_ix, min_iy), (max_ix, max_iy) = tile_keys(np.array([west, east]), np.array([south, north]), self.tile_size)
+        ix, iy = self.tile_keys[:, 0], self.tile_keys[:, 1]
+        inside = (ix >= min_ix) & (ix <= max_ix) & (iy >= min_iy) & (iy <= max_iy)
+        return [tuple(key) for key in self.tile_keys[inside].tolist()]
+
+    def region(self, north: float, south: float, east: float, west: float, margin: float = 0) -> StreetGraph:
+        '''
+        Street graph of every tile intersecting the bounds, grown by margin times their size on each side
+        '''
+        lat_margin = (north - south) * margin
+        lon_margin = (east - west) * margin
+        keys = tuple(self.tiles_in_bounds(north + lat_margin, south - lat_margin, east + lon_margin, west - lon_margin))
+        if not keys:
+            raise ValueError("no streets within bounds")
+
+        def load():
+            street_graph = merge_graphs([self.tile(*key) for key in keys])
+            if street_graph.path is None:
+                # indexes and distance fields built for the region are kept next to the tiles,
+                # a view can cover dozens of tiles so the directory is named by their hash
+                name = hashlib.sha1("+".join(f"{ix}_{iy}" for ix, iy in keys).encode()).hexdigest()[:16]
+                street_graph.path = os.path.join(self.tiles_path, "regions", name)
+                if os.path.isdir(street_graph.path):
+                    # marks it as recently used
+                    os.utime(street_graph.path)
+                else:
+                    os.makedirs(street_graph.path, exist_ok=True)
+                    self.prune_regions(keep=street_graph.path)
+            return street_graph
+
+        return self._get(("region",) + keys, load)
+
+    def prune_regions(self, keep: str | None = None):
+        '''
+        Deletes the least recently loaded region directories until they fit in disk_budget.
+        Workers still using a deleted region keep their loaded indexes and mapped fields,
+        the files only go away once they are closed
+        '''
+        regions_path = os.path.join(self.tiles_path, "regions")
+        regions = []
+        for entry in os.scandir(regions_path):
+            if entry.is_dir() and entry.path != keep:
+                regions.append((entry.stat().st_mtime, directory_nbytes(entry.path), entry.path))
+        total = sum(nbytes for _, nbytes, _ in regions)
+        for _, nbytes, path in sorted(regions):
+            if total <= self.disk_budget:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= nbytes
+
+
+if __name__ == "__main__":
+    # usage: python -m src.tiles LA.snapshot [tile size in degrees]
+    snapshot_path = sys.argv[1]
+    tile_size = float(sys.argv[2]) if len(sys.argv) > 2 else 0.02
+    build_tiles(load_snapshot(snapshot_path), os.path.join(snapshot_path, "tiles"), tile_size)
+    print(f"wrote {os.path.join(snapshot_path, 'tiles')}")
@@ -5,11 +5,10 @@ from dotenv import load_dotenv
 load_dotenv()
 from src.matrix import get_map
 from make_gpx import make_gpx
-import osmnx as ox
-import utm
 import numpy as np
 
 street_graph = get_map()
+node_index = street_graph.node_index
 
 pts = [
     [34.069578, -118.433760],
@@ -23,28 +22,16 @@ before_gpx = make_gpx(pts)
 with open("before.gpx", "w") as f:
     f.write(before_gpx)
 
-utm_pts_np = np.array(
-    [
-        utm.from_latlon(pt[0], pt[1])[:2]
-        for pt in pts
-    ]
-)
-
-utm_pts_metadata = [
-    utm.from_latlon(pt[0], pt[1])[2:]
-    for pt in pts
-]
+pts_np = np.array(pts)
+utm_pts_np = np.stack(node_index.to_projected(pts_np[:, 0], pts_np[:, 1]), axis=1)
 
 for _ in range(10):
     # find closes graph nodes to all points
-    node_ids = ox.distance.nearest_nodes(street_graph, utm_pts_np[:, 0], utm_pts_np[:, 1])
-    err_vectors = np.array([
-        [
-            street_graph.nodes[node_id]["x"] - utm_pts_np[i, 0],
-            street_graph.nodes[node_id]["y"] - utm_pts_np[i, 1]
-        ]
-        for i, node_id in enumerate(node_ids)
-    ])
+    _, node_ids = node_index.query(utm_pts_np[:, 0], utm_pts_np[:, 1])
+    err_vectors = np.stack([
+        node_index.x[node_ids] - utm_pts_np[:, 0],
+        node_index.y[node_ids] - utm_pts_np[:, 1]
+    ], axis=1)
 
     # print magnitude of error vectors
     print(utm_pts_np)
@@ -53,16 +40,8 @@ for _ in range(10):
     utm_pts_np = utm_pts_np + avg_err
 
 # snap to nearest road
-nearest_nodes = ox.distance.nearest_nodes(street_graph, utm_pts_np[:, 0], utm_pts_np[:, 1])
-utm_pts_np = np.array([
-    [street_graph.nodes[node_id]["x"], street_graph.nodes[node_id]["y"]]
-    for node_id in nearest_nodes
-])
-
-gps_coords = np.array([
-    utm.to_latlon(pt[0], pt[1], metadata[0], metadata[1])
-    for pt, metadata in zip(utm_pts_np, utm_pts_metadata)
-])
+_, nearest_nodes = node_index.query(utm_pts_np[:, 0], utm_pts_np[:, 1])
+gps_coords = np.stack(node_index.to_latlon(node_index.x[nearest_nodes], node_index.y[nearest_nodes]), axis=1)
 
 gpx = make_gpx(gps_coords.tolist())
 with open("test.gpx", "w") as f:
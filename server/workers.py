@@ -0,0 +1,151 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import BrokenExecutor, Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from fastapi import HTTPException
+
+# 0 runs requests on a thread in the server process, handy for development
+WORKERS = int(os.getenv("WORKERS", os.cpu_count() or 1))
+# requests running or waiting for a worker before new ones are turned away
+MAX_QUEUE = int(os.getenv("MAX_QUEUE", 2 * max(WORKERS, 1)))
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", 60))
+RETRY_AFTER = int(os.getenv("RETRY_AFTER", 5))
+
+
+class QueueEvents:
+    '''
+    on_event(event, data) callback for a worker, putting the event on a queue the server reads.
+    Picklable as long as the queue is, e.g. a manager's
+    '''
+
+    def __init__(self, events):
+        self.events = events
+
+    def __call__(self, event: str, data: dict):
+        self.events.put((event, data))
+
+
+class WorkerPool:
+    '''
+    Bounded pool running the CPU-bound pipeline off the event loop
+    '''
+
+    def __init__(self, workers: int, max_queue: int, timeout: float):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.pending = 0
+        self._pending_lock = threading.Lock()
+        self._executor: Executor | None = None
+        self._initializer = None
+        # worker processes can only reach queues a manager serves
+        self._manager = None
+        # threads blocked reading worker events, at most one per queued request
+        self._event_threads = ThreadPoolExecutor(max_workers=max(max_queue, 1), thread_name_prefix="events")
+
+    def start(self, initializer=None):
+        self._initializer = initializer
+        if self.workers > 0:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=initializer)
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=1, initializer=initializer)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+
+    def _restart(self, broken: Executor):
+        '''
+        Replaces an executor whose worker died, unless another request already did
+        '''
+        if self._executor is broken:
+            # its workers are already gone, waiting just joins the thread that noticed
+            broken.shutdown(wait=True, cancel_futures=True)
+            self.start(self._initializer)
+
+    def _finished(self, future):
+        # runs once the job completes or is cancelled, a timed out job still holds its worker until then
+        with self._pending_lock:
+            self.pending -= 1
+
+    async def run(self, fn, *args, timeout: float | None = None, **kwargs):
+        '''
+        Runs fn in a worker. fn gets a deadline keyword (time.time() timestamp) to stop early at.
+        Raises 503 with Retry-After when the queue is full and 504 when the timeout passes
+        '''
+        if self._executor is None:
+            self.start()
+        if self.pending >= self.max_queue:
+            raise HTTPException(
+                status_code=503,
+                detail="server busy",
+                headers={"Retry-After": str(RETRY_AFTER)},
+            )
+
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.time() + timeout
+        executor = self._executor
+        try:
+            future = executor.submit(fn, *args, deadline=deadline, **kwargs)
+        except BrokenExecutor:
+            # a worker died during an earlier request
+            self._restart(executor)
+            executor = self._executor
+            future = executor.submit(fn, *args, deadline=deadline, **kwargs)
+        with self._pending_lock:
+            self.pending += 1
+        future.add_done_callback(self._finished)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except TimeoutError:
+            # raised by wait_for, or by the worker itself once it passed the deadline
+            raise HTTPException(status_code=504, detail="request timed out")
+        except BrokenExecutor:
+            self._restart(executor)
+            raise HTTPException(
+                status_code=503,
+                detail="worker crashed",
+                headers={"Retry-After": str(RETRY_AFTER)},
+            )
+        finally:
+            # drops the job if it never started, e.g. when the client disconnected
+            future.cancel()
+
+
+    def _event_queue(self):
+        if self.workers == 0:
+            return queue.Queue()
+        if self._manager is None:
+            self._manager = multiprocessing.Manager()
+        return self._manager.Queue()
+
+    async def run_with_events(self, fn, *args, on_event, timeout: float | None = None, **kwargs):
+        '''
+        Like run, but fn also gets an on_event keyword to call with (event, data) in the worker.
+        Those calls are replayed to on_event here on the event loop as they happen
+        '''
+        events = self._event_queue()
+        loop = asyncio.get_running_loop()
+
+        async def forward():
+            while (item := await loop.run_in_executor(self._event_threads, events.get)) is not None:
+                on_event(*item)
+
+        forwarding = asyncio.create_task(forward())
+        try:
+            return await self.run(fn, *args, timeout=timeout, on_event=QueueEvents(events), **kwargs)
+        finally:
+            # the worker put its events before returning, so forward() ends right after them
+            events.put(None)
+            await forwarding
+
+
+pool = WorkerPool(WORKERS, MAX_QUEUE, REQUEST_TIMEOUT)